@@ -1,3 +1,4 @@
+import os
 import time
 import streamlit as st
 import vanna_calls as vc
@@ -27,48 +28,82 @@ def app_reload():
 def set_question(question):
     st.session_state.messages.append({"role": "user", "content": question, "type": "text"})
     st.session_state.suggestedQuestionList = False
-    generate_response(question)
-
-def generate_response(prompt, prePrint=False):
+    generate_response(question, banked=vc.get_banked_question(question))
+
+def write_stream(stream):
+    # A failed stream leaves no text behind, the partial output on screen is not kept
+    try:
+        return st.write_stream(stream) or None
+    except Exception as e:
+        print('Streaming failed: ' + str(e))
+        st.error("The response couldn't be completed")
+        return None
+
+def generate_response(prompt, prePrint=False, banked=None):
     with st.chat_message("assistant"):
         vc.add_turn_to_history(prompt)
-        plan, alternatives = vc.generate_interpretation_cached(prompt)
-        if plan:
-            if st.session_state.get("show_interpretation"):
-                interpretation_resp = vc.generate_interpretation_respond_cached(prompt, plan)
-                if prePrint:
-                    st.write(interpretation_resp)
-                st.session_state.messages.append({"role": "assistant", "content": interpretation_resp, "type": "text"})
-
-        sql = vc.generate_sql_cached(prompt, plan)
-        if sql:
-            
-            if vc.is_sql_valid_cached(sql):
-                if st.session_state.get("show_sql"):
+        pipeline = vc.build_response_pipeline(
+            prompt,
+            show_interpretation=st.session_state.get("show_interpretation"),
+            show_chart=st.session_state.get("show_chart"),
+            show_summary=st.session_state.get("show_summary"),
+            fallback_df=st.session_state.get("df"),
+            stream_text=prePrint,
+            banked=banked,
+        )
+        # Stages run concurrently in the pipeline, the output is still added in the usual order
+        with pipeline:
+            plan, alternatives = pipeline.result("interpretation")
+            if plan:
+                if st.session_state.get("show_interpretation"):
                     if prePrint:
-                        st.code(sql, language=sql, line_numbers=True, wrap_lines=True)
-                    st.session_state.messages.append({"role": "assistant", "content": sql, "type": "sql"})
-
-            else:
-                if prePrint:
-                    st.error(sql)
-                st.session_state.messages.append({"role": "assistant", "content": sql, "type": "error"})
-                st.stop()
-            
-            df = vc.run_sql_cached(sql)
+                        interpretation_resp = write_stream(vc.generate_interpretation_respond_stream(prompt, plan))
+                    else:
+                        interpretation_resp = pipeline.result("interpretation_respond")
+                    st.session_state.messages.append({"role": "assistant", "content": interpretation_resp, "type": "text"})
 
-            if df is not None:
-                st.session_state["df"] = df
+            sql = pipeline.result("sql")
+            if sql:
+                
+                if vc.is_sql_valid_cached(sql):
+                    if st.session_state.get("show_sql"):
+                        if prePrint:
+                            st.code(sql, language=sql, line_numbers=True, wrap_lines=True)
+                        st.session_state.messages.append({"role": "assistant", "content": sql, "type": "sql"})
 
-            if st.session_state.get("df") is not None:
-                if st.session_state.get("show_table"):
-                    df = st.session_state.get("df")
+                else:
+                    # Not SQL but the error message, the response to it is streamed
                     if prePrint:
-                        st.dataframe(df)
-                    st.session_state.messages.append({"role": "assistant", "content": df, "type": "dataframe"})
+                        error_response = write_stream(vc.generate_error_response_stream(prompt, sql))
+                    else:
+                        error_response = vc.generate_error_response(prompt, sql)
+                    st.session_state.messages.append({"role": "assistant", "content": error_response or "I wasn't able to generate SQL for that question", "type": "error"})
+                    st.stop()
+                
+                df = pipeline.result("df")
+
+                if df is not None:
+                    st.session_state["df"] = df
 
-                if vc.should_generate_chart_cached(prompt,sql,df):
-                    code = vc.generate_plotly_code_cached(prompt, sql, df)
+                if st.session_state.get("df") is not None:
+                    if st.session_state.get("show_table"):
+                        df = st.session_state.get("df")
+                        if prePrint:
+                            st.dataframe(df)
+                            if df.attrs.get('num_rows', len(df)) > len(df):
+                                st.caption('Showing the first ' + str(len(df)) + ' of ' + str(df.attrs['num_rows']) + ' rows')
+                        st.session_state.messages.append({"role": "assistant", "content": df, "type": "dataframe", "sql": sql})
+
+                    # The summary is streamed while the chart is still being generated
+                    chart_placeholder = st.empty()
+                    summary = None
+                    if st.session_state.get("show_summary"):
+                        if prePrint:
+                            summary = write_stream(vc.generate_summary_stream(prompt, df, alternatives))
+                        else:
+                            summary = pipeline.result("summary")
+
+                    code, fig = pipeline.result("chart")
                     ###if st.session_state.get("show_plotly_code"):
                         ###if(prePrint):
                             ###st.code(code, language="python", line_numbers=True, wrap_lines=True)
@@ -76,38 +111,32 @@ def generate_response(prompt, prePrint=False):
 
                     if code is not None and code != "":
                         if st.session_state.get("show_chart"):
-                            fig = vc.generate_plot_cached(code, df)
                             if fig is not None:
                                 if prePrint:
-                                    st.plotly_chart(fig, key=id(fig))
+                                    chart_placeholder.plotly_chart(fig, key=id(fig))
                                 st.session_state.messages.append({"role": "assistant", "content": fig, "type": "figure"})
-                            else: st.error("I couldn't generate a a chart")
-
-                if st.session_state.get("show_summary"):
-                    summary = vc.generate_summary_cached(prompt,df,alternatives)
+                            else: chart_placeholder.error("I couldn't generate a a chart")
 
                     if summary is not None:
-                        if prePrint:
-                            st.write(summary)
                         st.session_state.messages.append({"role": "assistant", "content": summary, "type": "text"})
 
-                #if st.session_state.get("show_followup"):
-                    #followup_questions = vc.generate_followup_cached(prompt, sql, df)
-                    #st.session_state["df"] = None
+                    #if st.session_state.get("show_followup"):
+                        #followup_questions = vc.generate_followup_cached(prompt, sql, df)
+                        #st.session_state["df"] = None
 
-                    #if len(followup_questions) > 0:
-                        #st.text(
-                            #"Here are some possible follow-up questions"
-                        #)
-                        # Print the first 5 follow-up questions
-                        #for question in followup_questions[:5]:
-                            #st.button(question, on_click=set_question, args=(question,))
+                        #if len(followup_questions) > 0:
+                            #st.text(
+                                #"Here are some possible follow-up questions"
+                            #)
+                            # Print the first 5 follow-up questions
+                            #for question in followup_questions[:5]:
+                                #st.button(question, on_click=set_question, args=(question,))
 
-        else:
-            errorMessage = "I wasn't able to generate SQL for that question"
-            if prePrint:
-                st.error(errorMessage)
-            st.session_state.messages.append({"role": "assistant", "content": errorMessage, "type": "error"})
+            else:
+                errorMessage = "I wasn't able to generate SQL for that question"
+                if prePrint:
+                    st.error(errorMessage)
+                st.session_state.messages.append({"role": "assistant", "content": errorMessage, "type": "error"})
     if prePrint:
         app_reload()
 
@@ -132,16 +161,21 @@ if "messages" not in st.session_state:
 with st.sidebar:
     st.title("Tools & Features")
 
-    db_mono = vc.get_runtimeParams()['db_mono']
-    current_tbl = vc.get_runtimeParams()['current_tbl']
+    runtime_params = vc.get_runtimeParams()
+    vc.prefill_question_bank(db_mono)
+    db_mono = runtime_params['db_mono']
+    current_tbl = runtime_params['current_tbl']
     col1, col2 = st.columns(2, gap="small")
     with col1:
         if st.button("New Chat", use_container_width=True):
             st.session_state.messages = []
             st.session_state.suggestedQuestionList = False
             st.session_state.explanation_open = False
+            st.session_state.last_sql = ''
+            st.session_state.last_explanation = ''
+            st.session_state.pop("df", None)
+            # Only this session starts over, the shared caches are keyed by the history
             vc.setUp_newVS()
-            st.cache_data.clear()
             greet_user()
             #save_chat_history([])  
     with col2:
@@ -154,10 +188,9 @@ with st.sidebar:
                 st.session_state.suggestedQuestionList = False
 
             else:
-                questions = vc.generate_questions_cached()
+                questions = vc.get_suggested_questions()
                 st.session_state.suggestedQuestionList = True
                 for i, question in enumerate(questions):
-                    time.sleep(0.05)
                     button = st.button(
                         question,
                         on_click=set_question,
@@ -177,20 +210,19 @@ with st.sidebar:
         )
 
         if st.session_state.get("dynamic_er-diagram"):
-            if direction == 'Left to Right': direct = '_LR'
-            else: direct = ''
-
-            code = vc.read_file('./ER-Diagram/erd_from_'+ db_mono + direct + '_sqlite.md')
-            stmd.st_mermaid(eval(code))
-        else:
+            code = vc.get_er_diagram(db_mono, direction == 'Left to Right')
+            stmd.st_mermaid(code)
+        elif os.path.exists('./ER-Diagram/erd_from_'+ db_mono +'_sqlite.png'):
             st.image('./ER-Diagram/erd_from_'+ db_mono +'_sqlite.png')
+        else:
+            st.code(vc.get_er_diagram(db_mono), language='mermaid')
              
 
     with st.expander('Table Preview'):
         with st.form('db',clear_on_submit=True):
             selectbox_val = st.selectbox(
                 "Explore your tables",
-                eval(vc.get_tableString(db_mono)),
+                vc.get_table_list(db_mono),
                 index=None,
                 placeholder="Select...",
                 )
@@ -205,10 +237,33 @@ with st.sidebar:
                 time.sleep(1)
                 app_reload()
 
-        tbl_df = vc.get_tbl_df(current_tbl,db_mono)
-        st.write('Preview of the table: ' + '**'+ current_tbl + '**')
+        # The keys of the shown pages, reset when another table is selected
+        if st.session_state.get("tbl_page_table") != current_tbl:
+            st.session_state.tbl_page_table = current_tbl
+            st.session_state.tbl_page_keys = [None]
+
+        tbl_df, next_key = vc.get_tbl_df(current_tbl, db_mono, st.session_state.tbl_page_keys[-1])
+        page = len(st.session_state.tbl_page_keys)
+        st.write('Preview of the table: ' + '**'+ current_tbl + '**' + ' (' + str(vc.get_tbl_row_count(current_tbl, db_mono)) + ' rows, page ' + str(page) + ')')
         st.dataframe(tbl_df)        
 
+        col1, col2 = st.columns(2, gap="small")
+        with col1:
+            if st.button("First page", use_container_width=True, disabled=page == 1):
+                st.session_state.tbl_page_keys = [None]
+                st.rerun()
+        with col2:
+            if st.button("Next page", use_container_width=True, disabled=next_key is None):
+                st.session_state.tbl_page_keys.append(next_key)
+                st.rerun()
+
+        if st.toggle("Column statistics", key="tbl_column_stats"):
+            st.dataframe(vc.get_tbl_column_stats(current_tbl, db_mono), hide_index=True)
+
+        if st.button("Persist defaults", use_container_width=True):
+            vc.persist_runtimeParams()
+            st.write("The current selection is now the default for new sessions.")
+
 
     with st.expander("Data Visualizer"):
         with st.form('generate Plot', clear_on_submit=True):
@@ -279,10 +334,9 @@ with st.sidebar:
             else:
                 if last_sql:
                     related_question = vc.get_related_question(last_sql, st.session_state.messages)
-                    explanation = vc.generate_sql_explanation_on_demand(last_sql, related_question)
+                    explanation = write_stream(vc.generate_sql_explanation_on_demand_stream(last_sql, related_question))
 
                     if explanation:
-                        st.write(explanation)
                         st.session_state.last_explanation = explanation
                         st.session_state.explantion_open = True
 
@@ -300,10 +354,23 @@ with st.sidebar:
 
 
 # Display chat messages from history on app rerun
-for message in st.session_state.messages:
+for i, message in enumerate(st.session_state.messages):
     with st.chat_message(message["role"]):
         if message["type"] == "dataframe":
-            st.dataframe(message["content"])
+            df = message["content"]
+            num_rows = df.attrs.get('num_rows', len(df))
+            if num_rows > len(df) and message.get("sql"):
+                # Only the first page is kept in the session, further pages are read from the stored result
+                num_pages = (num_rows + len(df) - 1) // len(df)
+                page = st.number_input('Page of ' + str(num_pages), min_value=1, max_value=num_pages, key='result_page_' + str(i))
+                page_df = vc.get_result_page(message["sql"], page - 1, len(df)) if page > 1 else df
+                if page_df is None:
+                    st.caption('This result is no longer stored, please run the query again.')
+                    page_df = df
+                st.dataframe(page_df)
+                st.caption(str(num_rows) + ' rows in total')
+            else:
+                st.dataframe(df)
             continue
         elif message["type"] == "figure":
             st.plotly_chart(message["content"], key = id(message["content"]))
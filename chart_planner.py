@@ -0,0 +1,70 @@
+import pandas as pd
+import plotly.express as px
+import plotly.graph_objects as go
+
+# Chart-Planner
+#   Writes the plotly-code for the common shapes of a result without asking the LLM.
+#   It is used for single values and for the results that should_generate_chart accepts,
+#   with the value columns of VN_QsBase.get_value_columns:
+#     a single value                  -> Indicator
+#     a time column and values        -> line chart
+#     a category column and values    -> bar chart
+#   Other shapes return None and are left to the LLM. The figure is built by running
+#   the returned code, so the code shown reproduces the chart.
+max_categories = 50
+max_values = 3
+
+def get_time_column(df: pd.DataFrame):
+    for col in df.columns:
+        if pd.api.types.is_datetime64_any_dtype(df[col]):
+            return col
+    # SQLite returns dates as text
+    for col in df.select_dtypes(include=['object']).columns:
+        name = str(col).lower()
+        if any(word in name for word in ("date", "time", "month", "year", "day")):
+            parsed = pd.to_datetime(df[col], errors='coerce', format='mixed')
+            if parsed.notna().mean() > 0.9:
+                return col
+    return None
+
+def get_category_column(df: pd.DataFrame):
+    for col in df.select_dtypes(include=['object', 'category', 'string']).columns:
+        if df[col].nunique() <= max_categories:
+            return col
+    return None
+
+def is_single_value(df: pd.DataFrame, value_cols: list) -> bool:
+    return len(df) == 1 and len(value_cols) == 1
+
+def get_chart_code(df: pd.DataFrame, value_cols: list) -> str:
+    if is_single_value(df, value_cols):
+        return f"fig = go.Figure(go.Indicator(mode='number', value=df[{value_cols[0]!r}].iloc[0], title={{'text': {str(value_cols[0])!r}}}))"
+    if len(value_cols) == 0 or len(value_cols) > max_values:
+        return None
+    # Besides the values only the x-axis column (and id-columns) may be in the result
+    other_cols = [col for col in df.columns if col not in value_cols and not str(col).lower().endswith("id")]
+    if len(other_cols) != 1:
+        return None
+
+    time_col = get_time_column(df[other_cols])
+    if time_col is not None:
+        return (
+            f"df = df.assign(**{{{time_col!r}: pd.to_datetime(df[{time_col!r}], errors='coerce', format='mixed')}}).sort_values({time_col!r})\n"
+            f"fig = px.line(df, x={time_col!r}, y={value_cols!r})"
+        )
+    category_col = get_category_column(df[other_cols])
+    if category_col is not None and df[category_col].is_unique:
+        return f"fig = px.bar(df, x={category_col!r}, y={value_cols!r}, barmode='group')"
+    return None
+
+def plan_chart(df: pd.DataFrame, value_cols: list, dark_mode: bool = True):
+    # Returns the plotly-code of the chart and its figure, or None
+    code = get_chart_code(df, value_cols)
+    if code is None:
+        return None
+    scope = {"df": df, "px": px, "go": go, "pd": pd}
+    exec(code, scope)
+    fig = scope["fig"]
+    if dark_mode:
+        fig.update_layout(template="plotly_dark")
+    return code, fig
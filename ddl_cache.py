@@ -0,0 +1,40 @@
+import threading
+
+# DDL-Cache
+#   Holds the DDL-collection in memory. It is filled once by the loader and then kept
+#   up to date by add()/remove(). Every change increases the epoch, so that caches
+#   which depend on the schema (e.g. answers) can tell that they are outdated.
+class DDLCache():
+    def __init__(self, loader):
+        self._loader = loader
+        self._entries = None
+        self._epoch = 0
+        self._lock = threading.RLock()
+
+    def get_all(self) -> list:
+        with self._lock:
+            if self._entries is None:
+                self._entries = dict(self._loader())
+            return list(self._entries.values())
+
+    def get_epoch(self) -> int:
+        return self._epoch
+
+    def add(self, id: str, ddl: str):
+        with self._lock:
+            if self._entries is not None:
+                if self._entries.get(id) == ddl:
+                    return
+                self._entries[id] = ddl
+            self._epoch += 1
+
+    def remove(self, id: str):
+        with self._lock:
+            if self._entries is not None:
+                self._entries.pop(id, None)
+            self._epoch += 1
+
+    def invalidate(self):
+        with self._lock:
+            self._entries = None
+            self._epoch += 1
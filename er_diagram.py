@@ -0,0 +1,60 @@
+import re
+import threading
+
+# ER-Diagram-Modul
+#   Builds the Mermaid class-diagram of a database from sqlite_master, PRAGMA table_info
+#   and PRAGMA foreign_key_list. Diagrams are kept per schema-hash, so a rerun only
+#   looks them up and a new diagram is built when the schema changes.
+def get_class_name(name: str) -> str:
+    return re.sub(r'\W', '_', name)
+
+def build_er_diagram(pool, db_id: str) -> str:
+    tables = pool.execute(db_id, "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name")[1]
+
+    classes = []
+    relations = []
+    for (tbl_name,) in tables:
+        quoted_name = '"' + tbl_name.replace('"', '""') + '"'
+
+        columns = pool.execute(db_id, 'PRAGMA table_info(' + quoted_name + ')')[1]
+        pk_columns = [col for col in columns if col[5] > 0]
+        # Only a single primary-key column is marked, like in the generated files
+        key_column = pk_columns[0] if len(pk_columns) == 1 else None
+        other_columns = sorted([col for col in columns if col is not key_column], key=lambda col: col[1])
+
+        lines = ['class ' + get_class_name(tbl_name) + '{']
+        if key_column is not None:
+            lines.append(' *' + (key_column[2] or 'ANY') + ' ' + get_class_name(key_column[1]))
+        for col in other_columns:
+            lines.append('   ' + (col[2] or 'ANY') + ' ' + get_class_name(col[1]))
+        lines.append('}')
+        classes.append('\n'.join(lines))
+
+        foreign_keys = pool.execute(db_id, 'PRAGMA foreign_key_list(' + quoted_name + ')')[1]
+        # A composite foreign-key is listed once per column, but drawn as one relation
+        for parent in dict((fk[0], fk[2]) for fk in foreign_keys).values():
+            relations.append(get_class_name(parent) + ' "0..1" -- "0..n" ' + get_class_name(tbl_name))
+
+    return '\n'.join(classes + relations) + '\n'
+
+class ERDiagramCache():
+    def __init__(self, pool):
+        self._pool = pool
+        self._lock = threading.Lock()
+        self._diagrams = {}
+
+    def get(self, db_id: str, left_to_right: bool = False) -> str:
+        key = (db_id, self._pool.get_schema_hash(db_id))
+        with self._lock:
+            body = self._diagrams.get(key)
+        if body is None:
+            body = build_er_diagram(self._pool, db_id)
+            with self._lock:
+                # Diagrams of an outdated schema are dropped
+                for old_key in [k for k in self._diagrams if k[0] == db_id]:
+                    del self._diagrams[old_key]
+                self._diagrams[key] = body
+
+        if left_to_right:
+            return 'classDiagram\ndirection LR\n' + body
+        return 'classDiagram\n' + body
@@ -1,13 +1,19 @@
 import tiktoken
+from functools import lru_cache
 
 ## Taken from OpenAI-Cookbook - How to count tokens with tiktoken
-def num_tokens_from_messages(messages, model="gpt-4o-mini-2024-07-18"):
-    """Return the number of tokens used by a list of messages."""
+#   The encoding and the message format are resolved once per model and then reused.
+@lru_cache(maxsize=None)
+def get_encoding(model="gpt-4o-mini-2024-07-18"):
     try:
-        encoding = tiktoken.encoding_for_model(model)
+        return tiktoken.encoding_for_model(model)
     except KeyError:
         print("Warning: model not found. Using o200k_base encoding.")
-        encoding = tiktoken.get_encoding("o200k_base")
+        return tiktoken.get_encoding("o200k_base")
+
+@lru_cache(maxsize=None)
+def get_message_format(model="gpt-4o-mini-2024-07-18"):
+    """Return the pinned model, tokens_per_message and tokens_per_name used for counting."""
     if model in {
         "gpt-3.5-turbo-0125",
         "gpt-4-0314",
@@ -17,24 +23,28 @@ def num_tokens_from_messages(messages, model="gpt-4o-mini-2024-07-18"):
         "gpt-4o-mini-2024-07-18",
         "gpt-4o-2024-08-06"
         }:
-        tokens_per_message = 3
-        tokens_per_name = 1
+        return model, 3, 1
     elif "gpt-3.5-turbo" in model:
         print("Warning: gpt-3.5-turbo may update over time. Returning num tokens assuming gpt-3.5-turbo-0125.")
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo-0125")
+        return get_message_format("gpt-3.5-turbo-0125")
     elif "gpt-4o-mini" in model:
         print("Warning: gpt-4o-mini may update over time. Returning num tokens assuming gpt-4o-mini-2024-07-18.")
-        return num_tokens_from_messages(messages, model="gpt-4o-mini-2024-07-18")
+        return get_message_format("gpt-4o-mini-2024-07-18")
     elif "gpt-4o" in model:
         print("Warning: gpt-4o and gpt-4o-mini may update over time. Returning num tokens assuming gpt-4o-2024-08-06.")
-        return num_tokens_from_messages(messages, model="gpt-4o-2024-08-06")
+        return get_message_format("gpt-4o-2024-08-06")
     elif "gpt-4" in model:
         print("Warning: gpt-4 may update over time. Returning num tokens assuming gpt-4-0613.")
-        return num_tokens_from_messages(messages, model="gpt-4-0613")
+        return get_message_format("gpt-4-0613")
     else:
         raise NotImplementedError(
             f"""num_tokens_from_messages() is not implemented for model {model}."""
         )
+
+def num_tokens_from_messages(messages, model="gpt-4o-mini-2024-07-18"):
+    """Return the number of tokens used by a list of messages."""
+    pinned_model, tokens_per_message, tokens_per_name = get_message_format(model)
+    encoding = get_encoding(pinned_model)
     num_tokens = 0
     for message in messages:
         num_tokens += tokens_per_message
@@ -43,4 +53,4 @@ def num_tokens_from_messages(messages, model="gpt-4o-mini-2024-07-18"):
             if key == "name":
                 num_tokens += tokens_per_name
     num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
-    return num_tokens
\ No newline at end of file
+    return num_tokens
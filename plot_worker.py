@@ -0,0 +1,184 @@
+import builtins
+import multiprocessing
+import queue
+import threading
+from functools import lru_cache
+from multiprocessing import shared_memory
+
+import pandas as pd
+import plotly.io as pio
+import pyarrow as pa
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, the memory limit is skipped there
+    resource = None
+
+# Plot-Worker
+#   Generated plotly-code runs in a pool of worker processes instead of the server.
+#   The DataFrame is handed over as Arrow IPC in shared memory and the figure comes
+#   back as JSON. A worker may use max_memory bytes, a call that takes longer than
+#   timeout seconds terminates only its own worker, which is replaced on the next call.
+#   Workers keep the most recently compiled code.
+#   The code only gets a reduced set of builtins (no open, eval, exec, ...) and may only
+#   import the modules in allowed_modules. This keeps ordinary generated code away from
+#   files and the server, it is no protection against deliberately hostile code.
+allowed_modules = {'plotly', 'pandas', 'numpy', 'math', 'datetime'}
+allowed_builtins = [
+    'abs', 'all', 'any', 'bool', 'dict', 'enumerate', 'filter', 'float', 'int', 'isinstance',
+    'len', 'list', 'map', 'max', 'min', 'print', 'range', 'reversed', 'round', 'set', 'slice',
+    'sorted', 'str', 'sum', 'tuple', 'zip', 'Exception', 'IndexError', 'KeyError', 'TypeError', 'ValueError',
+]
+
+def _restricted_import(name, globals=None, locals=None, fromlist=(), level=0):
+    if level != 0 or name.split('.')[0] not in allowed_modules:
+        raise ImportError('import of ' + name + ' is not allowed in plotly code')
+    return builtins.__import__(name, globals, locals, fromlist, level)
+
+def _get_builtins() -> dict:
+    restricted = {name: getattr(builtins, name) for name in allowed_builtins}
+    restricted['__import__'] = _restricted_import
+    return restricted
+
+def _init_worker(max_memory: int):
+    if resource is not None and max_memory:
+        try:
+            resource.setrlimit(resource.RLIMIT_AS, (max_memory, max_memory))
+        except (ValueError, OSError) as e:
+            print('Memory limit not set: ' + str(e))
+
+def _fallback_figure(df: pd.DataFrame):
+    # Like VannaBase.get_plotly_figure: a chart chosen by the column types
+    import plotly.express as px
+    numeric_cols = df.select_dtypes(include=["number"]).columns.tolist()
+    categorical_cols = df.select_dtypes(include=["object", "category", "string"]).columns.tolist()
+    if len(numeric_cols) >= 2:
+        return px.scatter(df, x=numeric_cols[0], y=numeric_cols[1])
+    elif len(numeric_cols) == 1 and len(categorical_cols) >= 1:
+        return px.bar(df, x=categorical_cols[0], y=numeric_cols[0])
+    elif len(categorical_cols) >= 1 and df[categorical_cols[0]].nunique() < 10:
+        return px.pie(df, names=categorical_cols[0])
+    return px.line(df)
+
+@lru_cache(maxsize=128)
+def _compile_plotly_code(plotly_code: str):
+    return compile(plotly_code, '<plotly_code>', 'exec')
+
+def _run_plotly_code(plotly_code: str, shm_name: str, size: int, dark_mode: bool) -> str:
+    import numpy as np
+    import plotly.express as px
+    import plotly.graph_objects as go
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        data = bytes(shm.buf[:size])
+    finally:
+        shm.close()
+    df = pa.ipc.open_stream(pa.BufferReader(data)).read_all().to_pandas()
+
+    scope = {"__builtins__": _get_builtins(), "df": df, "px": px, "go": go, "pd": pd, "np": np}
+    try:
+        exec(_compile_plotly_code(plotly_code), scope)
+        fig = scope.get("fig")
+    except Exception as e:
+        print('Plotly code failed: ' + str(e))
+        fig = _fallback_figure(df)
+
+    if fig is None:
+        return None
+    if dark_mode:
+        fig.update_layout(template="plotly_dark")
+    return fig.to_json()
+
+def to_arrow_ipc(df: pd.DataFrame) -> pa.Buffer:
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Columns with mixed types are handed over as text
+        table = pa.Table.from_pandas(df.astype({col: str for col in df.select_dtypes(include=['object']).columns}), preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue()
+
+def _serve(conn, max_memory: int):
+    _init_worker(max_memory)
+    while True:
+        try:
+            args = conn.recv()
+        except EOFError:
+            return
+        try:
+            conn.send(('ok', _run_plotly_code(*args)))
+        except Exception as e:
+            conn.send(('error', str(e)))
+
+class PlotWorker():
+    def __init__(self, context, max_memory: int):
+        self._conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_serve, args=(child_conn, max_memory), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def run(self, args: tuple, timeout: float):
+        self._conn.send(args)
+        if not self._conn.poll(timeout):
+            raise TimeoutError(f'plotly code was stopped after {timeout} seconds')
+        try:
+            status, value = self._conn.recv()
+        except EOFError:
+            raise ChildProcessError('plot worker died, e.g. on the memory limit')
+        if status == 'error':
+            raise RuntimeError(value)
+        return value
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join(1)
+        self._conn.close()
+
+class PlotWorkerPool():
+    def __init__(self, max_workers: int = 2, timeout: float = 10, max_memory: int = 2147483648):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.max_memory = max_memory
+        self._context = multiprocessing.get_context('spawn')
+        self._slots = threading.BoundedSemaphore(max_workers)
+        self._idle = queue.SimpleQueue()
+
+    def get_plotly_figure(self, plotly_code: str, df: pd.DataFrame, dark_mode: bool = True):
+        data = to_arrow_ipc(df)
+        shm = shared_memory.SharedMemory(create=True, size=max(data.size, 1))
+        self._slots.acquire()
+        worker = None
+        try:
+            shm.buf[:data.size] = memoryview(data).cast('B')
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                worker = PlotWorker(self._context, self.max_memory)
+            fig_json = worker.run((plotly_code, shm.name, data.size, dark_mode), self.timeout)
+            self._idle.put(worker)
+        except RuntimeError:
+            # The worker itself is fine, only this call failed
+            self._idle.put(worker)
+            raise
+        except (TimeoutError, ChildProcessError, OSError):
+            # Only the worker of this call is stopped, the other renders keep running
+            if worker is not None:
+                worker.stop()
+            raise
+        finally:
+            self._slots.release()
+            shm.close()
+            shm.unlink()
+
+        return None if fig_json is None else pio.from_json(fig_json)
+
+    def shutdown(self):
+        while True:
+            try:
+                self._idle.get_nowait().stop()
+            except queue.Empty:
+                return
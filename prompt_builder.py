@@ -0,0 +1,205 @@
+import bisect
+from functools import lru_cache
+
+import pandas as pd
+
+import openai_cookbook as oc
+
+@lru_cache(maxsize=None)
+def resolve_model(model: str) -> str:
+    # Models unknown to the cookbook are counted like gpt-4o
+    try:
+        oc.get_message_format(model)
+        return model
+    except (NotImplementedError, TypeError):
+        return "gpt-4o-2024-08-06"
+
+# Token count of a single text. DDLs and few-shot examples repeat from prompt to prompt,
+# so their counts are memoized instead of encoding them again.
+@lru_cache(maxsize=8192)
+def count_tokens(text: str, model: str) -> int:
+    pinned_model, tokens_per_message, tokens_per_name = oc.get_message_format(resolve_model(model))
+    return len(oc.get_encoding(pinned_model).encode(text))
+
+# Prompt-Builder
+#   Assembles a message-log within a token budget. The running count follows
+#   oc.num_tokens_from_messages: every message costs tokens_per_message plus its
+#   role and content, and the reply is primed with 3 tokens.
+class PromptBuilder():
+    def __init__(self, model: str, budget: int, system_message, user_message, assistant_message):
+        self.model = model
+        self.budget = budget
+        self._system_message = system_message
+        self._user_message = user_message
+        self._assistant_message = assistant_message
+
+        pinned_model, self._tokens_per_message, tokens_per_name = oc.get_message_format(resolve_model(model))
+        self.num_tokens = 3
+        self._reserved = 0
+        self._messages = []
+        self._text = []
+        self._text_tokens = 0
+
+    def count(self, text: str) -> int:
+        return count_tokens(text, self.model)
+
+    def count_message(self, message: dict) -> int:
+        return self._tokens_per_message + sum(self.count(value) for value in message.values())
+
+    def remaining(self) -> int:
+        return self.budget - self._reserved - self.num_tokens - self._text_tokens
+
+    def count_messages(self, messages: list) -> int:
+        return sum(self.count_message(message) for message in messages)
+
+    def reserve(self, tokens: int):
+        # Keeps room for text or messages that are added at the end and must not be dropped
+        self._reserved += tokens
+
+    def release(self, tokens: int):
+        self._reserved -= tokens
+
+    ## Text of the pending system-message
+    def append(self, text: str):
+        self._text.append(text)
+        self._text_tokens += self.count(text)
+
+    def append_items(self, header: str, items: list, item_format: str = "{}\n", max_tokens: int = None) -> int:
+        if len(items) == 0:
+            return 0
+
+        section_tokens = self.count(header)
+        if section_tokens > self.remaining():
+            return 0
+        self.append(header)
+
+        added = 0
+        for item in items:
+            text = item_format.format(item)
+            tokens = self.count(text)
+            if max_tokens is not None and section_tokens + tokens >= max_tokens:
+                continue
+            if tokens > self.remaining():
+                continue
+            self.append(text)
+            section_tokens += tokens
+            added += 1
+        return added
+
+    def flush_system(self):
+        if len(self._text) > 0:
+            message = self._system_message(''.join(self._text))
+            self._text = []
+            self._text_tokens = 0
+            self.add_message(message, force=True)
+
+    ## Messages
+    def add_message(self, message: dict, force: bool = False) -> bool:
+        return self.add_messages([message], force=force)
+
+    def add_messages(self, messages: list, force: bool = False) -> bool:
+        # Either all or none of the messages are added, e.g. a question with its SQL
+        tokens = self.count_messages(messages)
+        if not force and tokens > self.remaining():
+            return False
+        self._messages.extend(messages)
+        self.num_tokens += tokens
+        return True
+
+    def add_system(self, text: str, force: bool = False) -> bool:
+        return self.add_message(self._system_message(text), force=force)
+
+    def add_example(self, question: str, answer: str) -> bool:
+        return self.add_messages([self._user_message(question), self._assistant_message(answer)])
+
+    def get_messages(self) -> list:
+        self.flush_system()
+        return self._messages
+
+# Summary-Context
+#   Renders the largest prefix of a DataFrame that fits into a token budget. Every row
+#   is rendered and counted once, the prefix-length is then found by binary search over
+#   the running sums. Besides markdown the rows can be rendered as csv/tsv, and for
+#   frames that don't fit completely, statistics of all columns can be added.
+class DataFrameContext():
+    separators = {"markdown": " | ", "csv": ",", "tsv": "\t"}
+
+    def __init__(self, df: pd.DataFrame, count, representation: str = "markdown", max_rows: int = 100, with_stats: bool = False):
+        if representation not in self.separators:
+            raise ValueError('Unknown representation ' + representation)
+        self.df = df
+        self.count = count
+        self.representation = representation
+        self.max_rows = max_rows
+        self.with_stats = with_stats
+
+        self._lines = []
+        self._prefix_tokens = [0]
+
+    def _render_line(self, values) -> str:
+        separator = self.separators[self.representation]
+        values = [str(value).replace('\n', ' ') for value in values]
+        if self.representation == "markdown":
+            return "| " + separator.join(values) + " |\n"
+        values = ['"' + value.replace('"', '""') + '"' if separator in value or '"' in value else value for value in values]
+        return separator.join(values) + "\n"
+
+    def _render_header(self, columns) -> str:
+        header = self._render_line(columns)
+        if self.representation == "markdown":
+            header += "|" + "|".join(["---"] * len(columns)) + "|\n"
+        return header
+
+    def _count_rows(self, num_rows: int):
+        # Rows are only rendered and counted up to the requested prefix
+        start = len(self._lines)
+        for row in self.df.iloc[start:num_rows].itertuples(index=True, name=None):
+            line = self._render_line(row)
+            self._lines.append(line)
+            self._prefix_tokens.append(self._prefix_tokens[-1] + self.count(line))
+
+    def _fit_rows(self, budget: int) -> int:
+        limit = min(len(self.df), self.max_rows)
+        # Grows the counted prefix exponentially until it exceeds the budget ...
+        num_rows = 1
+        while len(self._lines) < limit and self._prefix_tokens[-1] <= budget:
+            num_rows = min(limit, num_rows * 2)
+            self._count_rows(num_rows)
+        # ... and searches the longest prefix within it
+        return bisect.bisect_right(self._prefix_tokens, budget) - 1
+
+    def render_stats(self) -> str:
+        stats = self.df.describe(include='all').transpose()
+        stats = stats.dropna(axis='columns', how='all')
+        if self.get_num_rows() > len(self.df):
+            text = f"Statistics of the first {len(self.df)} of {self.get_num_rows()} rows:\n"
+        else:
+            text = f"Statistics of all {len(self.df)} rows:\n"
+        text += self._render_header(['column'] + list(stats.columns))
+        for row in stats.itertuples(index=True, name=None):
+            text += self._render_line(['' if pd.isna(value) else f'{value:.6g}' if isinstance(value, float) else value for value in row])
+        return text
+
+    def get_num_rows(self) -> int:
+        # A preview of a larger result carries the number of rows of the whole result
+        return max(self.df.attrs.get('num_rows', len(self.df)), len(self.df))
+
+    def fit(self, budget: int) -> str:
+        header = self._render_header([''] + [str(col) for col in self.df.columns])
+        budget -= self.count(header)
+
+        stats = ''
+        if self.with_stats and self.get_num_rows() > self.max_rows:
+            stats = self.render_stats()
+            budget -= self.count(stats)
+
+        num_rows = self._fit_rows(budget)
+        if num_rows < 0:
+            return stats
+
+        table = header + ''.join(self._lines[:num_rows])
+        if num_rows < self.get_num_rows():
+            table += f"({num_rows} of {self.get_num_rows()} rows shown)\n"
+        if stats:
+            table = stats + '\n' + table
+        return table
@@ -0,0 +1,95 @@
+import threading
+
+# Question-Bank
+#   Suggestions are generated in the background for every schema, before anyone asks
+#   for them. Each question goes through interpretation, SQL generation and a one-row
+#   probe, only questions whose SQL returns rows are kept together with their plan and SQL.
+#   A suggestion is then served from the bank and its SQL is executed directly.
+class QuestionBank():
+    def __init__(self, vn, target_size: int = 15, max_rounds: int = 4):
+        self._vn = vn
+        self.target_size = target_size
+        self.max_rounds = max_rounds
+
+        self._lock = threading.Lock()
+        self._banks = {}
+        self._offsets = {}
+        self._jobs = {}
+
+    def _get_key(self, db_id: str):
+        return (db_id, self._vn._pool.get_schema_hash(db_id))
+
+    def prefill(self, db_id: str):
+        # Starts the background job once per schema, a changed schema gets a new bank
+        key = self._get_key(db_id)
+        with self._lock:
+            if key in self._jobs:
+                return key
+            for old_key in [k for k in self._banks if k[0] == db_id and k != key]:
+                del self._banks[old_key]
+                self._offsets.pop(old_key, None)
+                self._jobs.pop(old_key, None)
+            self._banks[key] = {}
+            self._offsets[key] = 0
+            job = threading.Thread(target=self._fill, args=(key,), daemon=True)
+            self._jobs[key] = job
+        job.start()
+        return key
+
+    def is_filling(self, db_id: str) -> bool:
+        job = self._jobs.get(self._get_key(db_id))
+        return job is not None and job.is_alive()
+
+    def get_questions(self, db_id: str, num: int = 5) -> list:
+        # Every call serves the next questions of the bank
+        key = self.prefill(db_id)
+        with self._lock:
+            entries = list(self._banks[key].values())
+            if len(entries) == 0:
+                return []
+            offset = self._offsets[key] % len(entries)
+            self._offsets[key] = offset + num
+        return [dict(entries[(offset + i) % len(entries)]) for i in range(min(num, len(entries)))]
+
+    def get_entry(self, db_id: str, question: str) -> dict:
+        with self._lock:
+            bank = self._banks.get(self._get_key(db_id), {})
+            entry = bank.get(question)
+            return None if entry is None else dict(entry)
+
+    def _fill(self, key):
+        db_id = key[0]
+        for _ in range(self.max_rounds):
+            with self._lock:
+                if self._banks.get(key) is None or len(self._banks[key]) >= self.target_size:
+                    return
+            try:
+                # The suggestions are independent of any conversation
+                questions = self._vn.new_user_context(db_id).generate_questions()
+            except Exception as e:
+                print('Question bank: generating questions failed: ' + str(e))
+                continue
+
+            for question in questions:
+                with self._lock:
+                    bank = self._banks.get(key)
+                    if bank is None or question in bank:
+                        continue
+                entry = self._validate(db_id, question)
+                if entry is not None:
+                    with self._lock:
+                        if self._banks.get(key) is not None:
+                            self._banks[key][question] = entry
+
+    def _validate(self, db_id: str, question: str) -> dict:
+        # Only probed (compiled and the first row fetched), the bank runs no whole queries
+        vn = self._vn.new_user_context(db_id)
+        try:
+            plan, alternatives = vn.get_interpretation(question)
+            sql, message = vn.generate_and_correct_sql(question, plan=plan, db_id=db_id, probe_only=True)
+        except Exception as e:
+            print('Question bank: validating "' + question + '" failed: ' + str(e))
+            return None
+        if message is not None:
+            return None
+        return {'question': question, 'plan': plan, 'alternatives': alternatives, 'sql': sql}
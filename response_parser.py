@@ -0,0 +1,108 @@
+import ast
+import json
+
+# Response-Parser
+#   LLM responses are parsed once into a result object. The outermost balanced
+#   {...} or [...] of the response is read as JSON, or as a Python literal if the
+#   model answered with a Python-dictionary. Brackets inside strings are skipped.
+def find_balanced(text: str, open_char: str, close_char: str) -> list:
+    candidates = []
+    depth = 0
+    start = None
+    quote = None
+    escaped = False
+    for i, char in enumerate(text):
+        if quote is not None:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == quote:
+                quote = None
+            continue
+
+        if char in ('"', "'") and depth > 0:
+            quote = char
+        elif char == open_char:
+            if depth == 0:
+                start = i
+            depth += 1
+        elif char == close_char and depth > 0:
+            depth -= 1
+            if depth == 0:
+                candidates.append(text[start:i + 1])
+    return candidates
+
+def parse_literal(text: str):
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        return None
+
+def parse_object(llm_response: str) -> dict:
+    if llm_response is None:
+        return None
+    for candidate in find_balanced(llm_response, '{', '}'):
+        result = parse_literal(candidate)
+        if isinstance(result, dict):
+            return result
+    return None
+
+def parse_list(llm_response: str) -> list:
+    if llm_response is None:
+        return None
+    for candidate in find_balanced(llm_response, '[', ']'):
+        result = parse_literal(candidate)
+        if isinstance(result, list):
+            return result
+    return None
+
+class Interpretation():
+    __slots__ = ('reasoning', 'most_likely', 'alternatives')
+
+    def __init__(self, reasoning: str = None, most_likely: str = None, alternatives: list = None):
+        self.reasoning = reasoning
+        self.most_likely = most_likely
+        self.alternatives = alternatives
+
+class Correction():
+    __slots__ = ('reasoning', 'corrected_sql')
+
+    def __init__(self, reasoning: str = None, corrected_sql: str = None):
+        self.reasoning = reasoning
+        self.corrected_sql = corrected_sql
+
+def parse_interpretation(llm_response: str) -> Interpretation:
+    result = parse_object(llm_response)
+    if result is None:
+        print("No valid dictionary found.")
+        return Interpretation()
+
+    alternatives = result.get("alternatives")
+    if isinstance(alternatives, str):
+        alternatives = [alternatives]
+    return Interpretation(result.get("chain_of_thought_reasoning"), result.get("most_likely"), alternatives)
+
+def parse_correction(llm_response: str) -> Correction:
+    result = parse_object(llm_response)
+    if result is None:
+        print("No valid dictionary found.")
+        return Correction()
+    return Correction(result.get("chain_of_thought_reasoning"), result.get("corrected_SQL"))
+
+def parse_question_list(llm_response: str) -> list:
+    # In JSON-mode the list is wrapped in an object
+    result = parse_object(llm_response)
+    if result is not None and isinstance(result.get("questions"), list):
+        questions = result["questions"]
+    else:
+        questions = parse_list(llm_response)
+
+    if questions is None:
+        print("No valid list found.")
+        return []
+    return [str(question) for question in questions]
@@ -0,0 +1,168 @@
+import atexit
+import os
+import shutil
+import tempfile
+import threading
+
+import pandas as pd
+import pyarrow as pa
+
+# Result-Store
+#   Query results are fetched in chunks until max_rows or max_bytes is reached. The first
+#   preview_rows rows stay in memory as a DataFrame, larger results are spilled to an
+#   Arrow IPC file, which is memory-mapped when a page is read. All chunks share one
+#   schema, a column whose type widens later on (e.g. NULLs or floats appear) widens it.
+class ResultHandle():
+    def __init__(self, columns: list, preview: pd.DataFrame, num_rows: int, truncated: bool, path: str = None):
+        self.columns = columns
+        self.preview = preview
+        self.num_rows = num_rows
+        self.truncated = truncated
+        self.path = path
+        self.spilled = path is not None
+        self._lock = threading.Lock()
+
+        # Downstream stages can tell from the preview itself that it isn't the whole result
+        self.preview.attrs['num_rows'] = num_rows
+        self.preview.attrs['truncated'] = truncated
+
+    def get_page(self, page: int, page_size: int = 1000) -> pd.DataFrame:
+        start = page * page_size
+        if not self.spilled:
+            return self.preview.iloc[start:start + page_size]
+        with self._lock:
+            if self.path is None or not os.path.exists(self.path):
+                return None
+            with pa.memory_map(self.path) as source:
+                table = pa.ipc.open_file(source).read_all()
+                return table.slice(start, page_size).to_pandas()
+
+    def get_num_pages(self, page_size: int = 1000) -> int:
+        return (self.num_rows + page_size - 1) // page_size
+
+    def close(self):
+        with self._lock:
+            if self.path is not None and os.path.exists(self.path):
+                os.remove(self.path)
+            self.path = None
+
+    def __del__(self):
+        # The spilled file of a session that ended is removed with its handle
+        self.close()
+
+class ResultStore():
+    def __init__(self, max_rows: int = 100000, max_bytes: int = 268435456, preview_rows: int = 1000, chunk_rows: int = 1000):
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.preview_rows = preview_rows
+        self.chunk_rows = chunk_rows
+
+        self._directory = tempfile.mkdtemp(prefix='vn_results_')
+        atexit.register(shutil.rmtree, self._directory, True)
+
+    def fetch(self, pool, db_id: str, sql: str, timeout: float = None) -> ResultHandle:
+        with pool.connection(db_id, timeout=timeout) as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(sql)
+                columns = [col[0] for col in cursor.description] if cursor.description else []
+                return self._fetch_chunks(cursor, columns)
+            finally:
+                cursor.close()
+
+    def _to_batch(self, rows: list, columns: list) -> pa.RecordBatch:
+        # Built column by column, so that NULLs keep integer columns integer
+        arrays = []
+        for values in zip(*rows):
+            try:
+                arrays.append(pa.array(values))
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                # SQLite allows mixed types in a column, such columns are kept as text
+                arrays.append(pa.array([None if value is None else str(value) for value in values], pa.string()))
+        return pa.RecordBatch.from_arrays(arrays, names=columns)
+
+    def _unify(self, schema: pa.Schema, other: pa.Schema) -> pa.Schema:
+        # Field by field, result columns may have duplicate names
+        fields = []
+        for field, other_field in zip(schema, other):
+            if field.type == other_field.type:
+                fields.append(field)
+                continue
+            try:
+                fields.append(pa.unify_schemas([pa.schema([field]), pa.schema([other_field])], promote_options='permissive').field(0))
+            except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+                fields.append(pa.field(field.name, pa.string()))
+        return pa.schema(fields)
+
+    def _new_spill_file(self, schema: pa.Schema):
+        fd, path = tempfile.mkstemp(suffix='.arrow', dir=self._directory)
+        os.close(fd)
+        return pa.ipc.new_file(path, schema), path
+
+    def _respill(self, path: str, schema: pa.Schema):
+        # The type of a column changed after rows were spilled, they are copied into a file with the wider schema
+        writer, new_path = self._new_spill_file(schema)
+        with pa.memory_map(path) as source:
+            writer.write_table(pa.ipc.open_file(source).read_all().cast(schema))
+        os.remove(path)
+        return writer, new_path
+
+    def _fetch_chunks(self, cursor, columns: list) -> ResultHandle:
+        preview = []
+        batches = []
+        writer = None
+        schema = None
+        path = None
+        num_rows = 0
+        num_bytes = 0
+        truncated = False
+
+        try:
+            while True:
+                rows = cursor.fetchmany(self.chunk_rows)
+                if len(rows) == 0:
+                    break
+                if num_rows + len(rows) > self.max_rows:
+                    rows = rows[:self.max_rows - num_rows]
+                    truncated = True
+
+                if len(preview) < self.preview_rows:
+                    preview.extend(rows[:self.preview_rows - len(preview)])
+
+                try:
+                    batch = self._to_batch(rows, columns)
+                    new_schema = batch.schema if schema is None else self._unify(schema, batch.schema)
+                    if writer is None:
+                        batches.append(batch)
+                        schema = new_schema
+                        if num_rows + len(rows) > self.preview_rows:
+                            # The result doesn't fit into the preview, from now on it is spilled to disk
+                            writer, path = self._new_spill_file(schema)
+                            for earlier_batch in batches:
+                                writer.write_batch(earlier_batch.cast(schema))
+                            batches = []
+                    else:
+                        if new_schema != schema:
+                            spilled_writer, writer = writer, None
+                            spilled_writer.close()
+                            writer, path = self._respill(path, new_schema)
+                            schema = new_schema
+                        writer.write_batch(batch.cast(schema))
+                except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError, ValueError) as e:
+                    print('Result can not be spilled: ' + str(e))
+                    if path is None:
+                        num_rows = len(preview)
+                    truncated = True
+                    break
+
+                num_rows += len(rows)
+                num_bytes += batch.nbytes
+                if truncated or num_bytes > self.max_bytes:
+                    truncated = True
+                    break
+        finally:
+            if writer is not None:
+                writer.close()
+
+
+        return ResultHandle(columns, pd.DataFrame.from_records(preview, columns=columns), num_rows, truncated, path)
@@ -0,0 +1,63 @@
+import atexit
+import os
+import tempfile
+import threading
+
+import toml
+
+# Runtime-Settings
+#   The defaults are read from the toml-file once per process. Every session works on its
+#   own copy, so a selection of one user doesn't change the settings of the others. The
+#   file is only written by persist_defaults(), atomically and debounced: calls within the
+#   debounce-window reset a timer and only the latest values are written when it fires.
+class RuntimeSettings():
+    def __init__(self, path: str, debounce: float = 2.0):
+        self.path = path
+        self.debounce = debounce
+        self._lock = threading.Lock()
+        self._defaults = None
+        self._pending = None
+        self._timer = None
+        atexit.register(self.flush)
+
+    def get_defaults(self) -> dict:
+        with self._lock:
+            if self._defaults is None:
+                self._defaults = toml.load(self.path)
+            return dict(self._defaults)
+
+    def get_session_settings(self, session_state, key: str = "runtime_params") -> dict:
+        if key not in session_state:
+            session_state[key] = self.get_defaults()
+        return session_state[key]
+
+    def persist_defaults(self, values: dict):
+        # New sessions get the values at once, the file follows after the debounce
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._defaults = dict(values)
+            self._pending = dict(values)
+            self._timer = threading.Timer(self.debounce, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            values, self._pending = self._pending, None
+            if values is None:
+                return
+
+            # The new file is written next to the old one and then swapped in
+            directory = os.path.dirname(os.path.abspath(self.path))
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    toml.dump(values, f)
+                os.replace(tmp_path, self.path)
+            except Exception:
+                os.remove(tmp_path)
+                raise
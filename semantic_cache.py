@@ -0,0 +1,104 @@
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+# Semantic-Cache
+#   Stores the plan and the validated SQL of a question under its embedding. A new
+#   question is answered from the cache, if a stored question is similar enough.
+#   Entries expire after ttl seconds, the least recently used entries are evicted
+#   beyond max_entries, and the whole cache is dropped when the schema-epoch changes.
+class SemanticCache():
+    def __init__(self, embed, threshold: float = 0.95, max_entries: int = 512, ttl: float = 86400):
+        self._embed = embed
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._matrix = None
+        self._keys = []
+        self._epoch = None
+        self._embeddings = OrderedDict()
+
+    def _normalize(self, question: str) -> str:
+        return ' '.join(question.lower().split())
+
+    def _get_embedding(self, key: str) -> np.ndarray:
+        with self._lock:
+            if key in self._embeddings:
+                self._embeddings.move_to_end(key)
+                return self._embeddings[key]
+
+        vector = np.asarray(self._embed(key), dtype=np.float32)
+        vector = vector / (np.linalg.norm(vector) or 1.0)
+
+        with self._lock:
+            self._embeddings[key] = vector
+            while len(self._embeddings) > self.max_entries:
+                self._embeddings.popitem(last=False)
+        return vector
+
+    def _check_epoch(self, epoch):
+        if epoch != self._epoch:
+            self._entries.clear()
+            self._matrix = None
+            self._epoch = epoch
+
+    def _evict(self):
+        now = time.monotonic()
+        expired = [key for key, entry in self._entries.items() if now - entry['created'] > self.ttl]
+        for key in expired:
+            del self._entries[key]
+        evicted = len(expired)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            evicted += 1
+        if evicted > 0:
+            self._matrix = None
+
+    def lookup(self, question: str, epoch) -> dict:
+        key = self._normalize(question)
+        vector = self._get_embedding(key)
+
+        with self._lock:
+            self._check_epoch(epoch)
+            self._evict()
+            if len(self._entries) == 0:
+                return None
+
+            if key in self._entries:
+                match = key
+            else:
+                if self._matrix is None:
+                    self._keys = list(self._entries.keys())
+                    self._matrix = np.stack([self._entries[k]['vector'] for k in self._keys])
+                similarities = self._matrix @ vector
+                best = int(np.argmax(similarities))
+                if similarities[best] < self.threshold:
+                    return None
+                match = self._keys[best]
+
+            self._entries.move_to_end(match)
+            return dict(self._entries[match]['values'])
+
+    def store(self, question: str, epoch, **values):
+        key = self._normalize(question)
+        vector = self._get_embedding(key)
+
+        with self._lock:
+            self._check_epoch(epoch)
+            if key in self._entries:
+                self._entries[key]['values'].update(values)
+                self._entries.move_to_end(key)
+            else:
+                self._entries[key] = {'vector': vector, 'values': dict(values), 'created': time.monotonic()}
+                self._matrix = None
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
@@ -0,0 +1,88 @@
+import re
+
+from sql_metadata import Parser
+from sql_metadata.keywords_lists import QueryType
+
+# SQL-Analyzer
+#   Checks a generated query before it reaches the database: only SELECT statements
+#   are accepted, and EXPLAIN QUERY PLAN compiles the query (unknown tables and columns
+#   fail here) and gives the cost estimate. Queries above max_query_cost are sent back
+#   for rewriting. The size of the result is capped by the ResultStore, not here.
+class SQLAnalysis():
+    __slots__ = ('sql', 'error', 'cost')
+
+    def __init__(self, sql: str, error: str = None, cost: int = None):
+        self.sql = sql
+        self.error = error
+        self.cost = cost
+
+class SQLAnalyzer():
+    def __init__(self, pool, table_browser, max_query_cost: int = 10000000):
+        self._pool = pool
+        self._table_browser = table_browser
+        self.max_query_cost = max_query_cost
+
+    def analyze(self, sql: str, db_id: str) -> SQLAnalysis:
+        if sql is None:
+            return SQLAnalysis(sql, "no sql to analyze")
+        sql = sql.strip().rstrip(';').strip()
+
+        try:
+            parser = Parser(sql)
+            query_type = parser.query_type
+        except Exception as e:
+            # sql_metadata doesn't know every construct, the database has the last word
+            print('SQL analysis skipped: ' + str(e))
+            return SQLAnalysis(sql)
+
+        if query_type != QueryType.SELECT:
+            return SQLAnalysis(sql, "only SELECT statements are allowed, not " + str(query_type.value))
+
+        try:
+            cost = self._estimate_cost(sql, parser, db_id)
+        except Exception as e:
+            return SQLAnalysis(sql, str(e))
+
+        if cost > self.max_query_cost:
+            return SQLAnalysis(sql, f"the query would read about {cost} rows in nested full table scans or correlated subqueries, check the join conditions and filters", cost)
+        return SQLAnalysis(sql, None, cost)
+
+    def _estimate_cost(self, sql: str, parser: Parser, db_id: str) -> int:
+        columns, plan = self._pool.execute(db_id, 'EXPLAIN QUERY PLAN ' + sql)
+        try:
+            aliases = {alias.lower(): table for alias, table in parser.tables_aliases.items()}
+        except Exception:
+            aliases = {}
+        tables = {table.lower(): table for table in self._table_browser.get_tables(db_id)}
+
+        children = {}
+        for node_id, parent, notused, detail in plan:
+            children.setdefault(parent, []).append((node_id, detail))
+
+        def get_rows(detail: str) -> int:
+            match = re.match(r'SCAN (\S+)', detail)
+            if match is None:
+                # SEARCH uses an index, counted as a single row
+                return 1
+            name = match.group(1).lower()
+            tbl_name = tables.get(aliases.get(name, name).lower())
+            if tbl_name is None:
+                # A materialized subquery or co-routine, its own cost is counted where it is built
+                return 1
+            return max(self._table_browser.get_row_count(db_id, tbl_name), 1)
+
+        def get_cost(node_id) -> int:
+            # Scans and searches of one level are nested loops, their rows multiply. A correlated
+            # subquery runs once per row of these loops, other subqueries run once and add up.
+            loops = None
+            once = 0
+            for child_id, detail in children.get(node_id, []):
+                if detail.startswith('SCAN ') or detail.startswith('SEARCH '):
+                    loops = (loops or 1) * get_rows(detail)
+                elif detail.startswith('CORRELATED '):
+                    loops = (loops or 1) * max(get_cost(child_id), 1)
+                else:
+                    once += get_cost(child_id)
+            return (loops or 0) + once
+
+        return get_cost(0)
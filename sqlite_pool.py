@@ -0,0 +1,147 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import quote
+
+import pandas as pd
+
+# Connection-Modul
+#   Read-only connections are opened once per database and reused by every
+#   session. A progress-handler cancels queries that exceed the time limit.
+class SQLitePool():
+    def __init__(
+        self,
+        db_loc: str,
+        max_connections: int = 8,
+        immutable: tuple = (),
+        query_timeout: float = 10,
+        mmap_size: int = 268435456,
+        cache_size: int = -65536,
+        progress_steps: int = 10000,
+    ):
+        self.db_loc = db_loc
+        self.max_connections = max_connections
+        # Databases whose file is known to never change, SQLite then skips locking and change-detection
+        self.immutable = set(immutable)
+        self.query_timeout = query_timeout
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size
+        self.progress_steps = progress_steps
+
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._slots = {}
+        self._schema_hashes = {}
+
+    def get_db_path(self, db_id: str) -> str:
+        return self.db_loc + '/' + db_id + '/' + db_id + '.sqlite'
+
+    def _open(self, db_id: str) -> sqlite3.Connection:
+        db_path = os.path.abspath(self.get_db_path(db_id))
+        if not os.path.exists(db_path):
+            raise FileNotFoundError('No database found for ' + db_id + ' at ' + db_path)
+
+        uri = 'file:' + quote(db_path) + '?mode=ro'
+        if db_id in self.immutable:
+            uri += '&immutable=1'
+
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        conn.text_factory = lambda b: b.decode('utf-8', errors='replace')
+        conn.execute('PRAGMA query_only = ON')
+        conn.execute(f'PRAGMA mmap_size = {int(self.mmap_size)}')
+        conn.execute(f'PRAGMA cache_size = {int(self.cache_size)}')
+        return conn
+
+    def _get_slots(self, db_id: str) -> threading.BoundedSemaphore:
+        with self._lock:
+            if db_id not in self._slots:
+                self._slots[db_id] = threading.BoundedSemaphore(self.max_connections)
+                self._idle[db_id] = []
+            return self._slots[db_id]
+
+    @contextmanager
+    def connection(self, db_id: str, timeout: float = None):
+        slots = self._get_slots(db_id)
+        slots.acquire()
+        try:
+            with self._lock:
+                conn = self._idle[db_id].pop() if self._idle[db_id] else None
+            if conn is None:
+                conn = self._open(db_id)
+        except Exception:
+            slots.release()
+            raise
+
+        timeout = self.query_timeout if timeout is None else timeout
+        if timeout:
+            deadline = time.monotonic() + timeout
+            conn.set_progress_handler(lambda: time.monotonic() > deadline, self.progress_steps)
+
+        broken = False
+        try:
+            yield conn
+        except sqlite3.OperationalError as e:
+            if str(e) == 'interrupted':
+                raise sqlite3.OperationalError(f'query was cancelled after exceeding the time limit of {timeout} seconds') from e
+            broken = not self._is_usable(conn)
+            raise
+        finally:
+            conn.set_progress_handler(None, 0)
+            if broken:
+                conn.close()
+            else:
+                with self._lock:
+                    self._idle[db_id].append(conn)
+            slots.release()
+
+    def _is_usable(self, conn: sqlite3.Connection) -> bool:
+        try:
+            conn.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def execute(self, db_id: str, sql: str, max_rows: int = None, params=(), timeout: float = None):
+        with self.connection(db_id, timeout=timeout) as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(sql, params)
+                columns = [col[0] for col in cursor.description] if cursor.description else []
+                rows = cursor.fetchall() if max_rows is None else cursor.fetchmany(max_rows)
+            finally:
+                cursor.close()
+        return columns, rows
+
+    def run_sql(self, db_id: str, sql: str, params=(), timeout: float = None) -> pd.DataFrame:
+        columns, rows = self.execute(db_id, sql, params=params, timeout=timeout)
+        return pd.DataFrame.from_records(rows, columns=columns)
+
+    def get_schema_version(self, db_id: str) -> int:
+        # The schema-cookie of the database-file, increased by every CREATE/ALTER/DROP
+        columns, rows = self.execute(db_id, 'PRAGMA schema_version')
+        return rows[0][0]
+
+    def get_schema_hash(self, db_id: str) -> str:
+        # Changes with every CREATE/ALTER/DROP, independent of the data. sqlite_master is
+        # only read again when the schema-version changed.
+        version = self.get_schema_version(db_id)
+        with self._lock:
+            cached = self._schema_hashes.get(db_id)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        columns, rows = self.execute(db_id, 'SELECT type, name, tbl_name, sql FROM sqlite_master ORDER BY type, name')
+        schema_hash = hashlib.sha1(repr(rows).encode()).hexdigest()
+        with self._lock:
+            self._schema_hashes[db_id] = (version, schema_hash)
+        return schema_hash
+
+    def close_all(self):
+        with self._lock:
+            for connections in self._idle.values():
+                for conn in connections:
+                    conn.close()
+                connections.clear()
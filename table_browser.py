@@ -0,0 +1,98 @@
+import re
+import threading
+
+import pandas as pd
+
+# Table-Browser
+#   Table-lists, row-counts and column-statistics are computed once per schema-hash.
+#   Previews are paged by keyset on the rowid, or on the primary-key of WITHOUT ROWID
+#   tables, so a later page doesn't scan the rows before it like OFFSET does.
+def quote_identifier(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+class TableBrowser():
+    def __init__(self, pool, page_size: int = 10):
+        self._pool = pool
+        self.page_size = page_size
+        self._lock = threading.Lock()
+        self._cache = {}
+
+    def _cached(self, db_id: str, key: tuple, compute):
+        schema_hash = self._pool.get_schema_hash(db_id)
+        cache_key = (db_id, schema_hash) + key
+        with self._lock:
+            if cache_key in self._cache:
+                return self._cache[cache_key]
+        value = compute()
+        with self._lock:
+            # Entries of an outdated schema are dropped
+            for old_key in [k for k in self._cache if k[0] == db_id and k[1] != schema_hash]:
+                del self._cache[old_key]
+            self._cache[cache_key] = value
+        return value
+
+    def get_tables(self, db_id: str) -> list:
+        def compute():
+            columns, rows = self._pool.execute(db_id, "SELECT tbl_name FROM sqlite_master WHERE sql is not null and type = 'table' and tbl_name not like '%sqlite%' ORDER BY tbl_name")
+            return [row[0] for row in rows]
+        return self._cached(db_id, ('tables',), compute)
+
+    def _check_table(self, db_id: str, tbl_name: str):
+        if tbl_name not in self.get_tables(db_id):
+            raise ValueError('Unknown table ' + str(tbl_name) + ' in ' + db_id)
+
+    def get_key_columns(self, db_id: str, tbl_name: str) -> list:
+        self._check_table(db_id, tbl_name)
+        def compute():
+            columns, rows = self._pool.execute(db_id, "SELECT sql FROM sqlite_master WHERE type = 'table' and tbl_name = ?", params=(tbl_name,))
+            if not re.search(r'WITHOUT\s+ROWID\s*$', rows[0][0].strip().rstrip(';'), re.IGNORECASE):
+                return ['rowid']
+            columns, table_info = self._pool.execute(db_id, 'PRAGMA table_info(' + quote_identifier(tbl_name) + ')')
+            pk_columns = sorted([col for col in table_info if col[5] > 0], key=lambda col: col[5])
+            return [quote_identifier(col[1]) for col in pk_columns]
+        return self._cached(db_id, ('keys', tbl_name), compute)
+
+    def get_page(self, db_id: str, tbl_name: str, after: tuple = None, page_size: int = None):
+        # Returns the rows after the given key and the key to continue with, None on the last page
+        key_columns = self.get_key_columns(db_id, tbl_name)
+        page_size = page_size or self.page_size
+
+        key_select = ', '.join(key + ' AS __key_' + str(i) for i, key in enumerate(key_columns))
+        sql = 'SELECT ' + key_select + ', * FROM ' + quote_identifier(tbl_name)
+        params = ()
+        if after is not None:
+            sql += ' WHERE (' + ', '.join(key_columns) + ') > (' + ', '.join('?' * len(key_columns)) + ')'
+            params = tuple(after)
+        sql += ' ORDER BY ' + ', '.join(key_columns) + ' LIMIT ' + str(int(page_size) + 1)
+
+        columns, rows = self._pool.execute(db_id, sql, params=params)
+        num_keys = len(key_columns)
+        next_key = tuple(rows[page_size - 1][:num_keys]) if len(rows) > page_size else None
+        rows = [row[num_keys:] for row in rows[:page_size]]
+        return pd.DataFrame.from_records(rows, columns=columns[num_keys:]), next_key
+
+    def get_row_count(self, db_id: str, tbl_name: str) -> int:
+        self._check_table(db_id, tbl_name)
+        def compute():
+            columns, rows = self._pool.execute(db_id, 'SELECT count(*) FROM ' + quote_identifier(tbl_name))
+            return rows[0][0]
+        return self._cached(db_id, ('count', tbl_name), compute)
+
+    def get_column_stats(self, db_id: str, tbl_name: str) -> pd.DataFrame:
+        self._check_table(db_id, tbl_name)
+        def compute():
+            columns, table_info = self._pool.execute(db_id, 'PRAGMA table_info(' + quote_identifier(tbl_name) + ')')
+            # All statistics are collected in a single scan of the table
+            aggregates = []
+            for col in table_info:
+                name = quote_identifier(col[1])
+                aggregates += ['count(' + name + ')', 'count(DISTINCT ' + name + ')', 'min(' + name + ')', 'max(' + name + ')']
+            columns, rows = self._pool.execute(db_id, 'SELECT ' + ', '.join(aggregates) + ' FROM ' + quote_identifier(tbl_name))
+            values = rows[0]
+            # min/max are kept as text, a column may hold values of different types
+            stats = []
+            for i, col in enumerate(table_info):
+                non_null, distinct, min_value, max_value = values[4 * i:4 * i + 4]
+                stats.append([col[1], col[2], non_null, distinct, None if min_value is None else str(min_value), None if max_value is None else str(max_value)])
+            return pd.DataFrame(stats, columns=['column', 'type', 'non_null', 'distinct', 'min', 'max'])
+        return self._cached(db_id, ('stats', tbl_name), compute).copy()
@@ -0,0 +1,47 @@
+import argparse
+import os
+
+import toml
+from dotenv import load_dotenv
+from qdrant_client import QdrantClient
+
+from vn_qsBase_session import VN_QsBase
+
+# Bulk-Training
+#   Trains the DDL-collection with all tables of a database, e.g.
+#   python train_schema.py Chinook
+#   Tables that were trained before with the same DDL are skipped, tables that were
+#   dropped from the database are removed. Runs without streamlit: the keys are read
+#   from .streamlit/secrets.toml or, if missing there, from the environment/.env.
+load_dotenv('.env')
+
+def get_secret(secrets: dict, name: str):
+    return secrets.get(name, os.getenv(name))
+
+def get_config(secrets_path: str) -> dict:
+    secrets = toml.load(secrets_path) if os.path.exists(secrets_path) else {}
+    # Collections and model like vanna_calls.get_config
+    return {
+        "client": QdrantClient(url=get_secret(secrets, 'QDRANT_URL'), api_key=get_secret(secrets, 'QDRANT_API_KEY')),
+        "fastembed_model": 'BAAI/bge-base-en-v1.5',
+        "sql_collection_name": 'zero_sql',
+        "ddl_collection_name": 'experiment_ddl',
+        "api_key": get_secret(secrets, 'OpenAI_API_KEY_DEV'),
+        "model": 'gpt-4o-mini',
+        "db_loc": get_secret(secrets, 'dbLoc'),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Train the DDL-collection with all tables of a database')
+    parser.add_argument('db_name', help='name of the database in dbLoc, e.g. Chinook')
+    parser.add_argument('--batch-size', type=int, default=64, help='points per upsert to qdrant')
+    parser.add_argument('--examples', type=int, default=2, help='example rows per table')
+    parser.add_argument('--secrets', default='.streamlit/secrets.toml', help='streamlit secrets with the keys')
+    args = parser.parse_args()
+
+    vn = VN_QsBase(config=get_config(args.secrets))
+    result = vn.train_schema(args.db_name, batch_size=args.batch_size, num_examples=args.examples)
+    print('Trained ' + str(result['trained']) + ' tables, removed ' + str(result['removed']) + ' outdated points (' + str(result['dropped']) + ' of dropped tables) and skipped ' + str(result['unchanged']) + ' unchanged tables of ' + args.db_name)
+
+if __name__ == '__main__':
+    main()
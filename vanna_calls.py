@@ -2,11 +2,21 @@ import streamlit as st
 
 #Added Packages
 from vn_qsBase_session import VN_QsBase
+from vn_pipeline import StagePipeline
+from semantic_cache import SemanticCache
+from er_diagram import ERDiagramCache
+from runtime_settings import RuntimeSettings
+from chart_planner import plan_chart, is_single_value
+from question_bank import QuestionBank
 from dotenv import load_dotenv
 from qdrant_client import QdrantClient
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+import threading
+from collections import OrderedDict
+import hashlib
+import pandas as pd
 
 #import shelve
-import toml
 
 #Added for setup_vanna()
 load_dotenv('.env')
@@ -30,20 +40,155 @@ def get_config():
         "sql_collection_name" : 'zero_sql',
         "ddl_collection_name" : 'experiment_ddl',
         "api_key": st.secrets.get('OpenAI_API_KEY_DEV'),
-        "model": 'gpt-4o-mini'
+        "model": 'gpt-4o-mini',
+        "db_loc": st.secrets.get('dbLoc'),
+        # Only databases whose file never changes, otherwise schema-changes go unnoticed
+        "db_immutable": [],
+        "query_timeout": 10,
+        "json_mode": True,
+        "semantic_cache_threshold": 0.95,
+        "semantic_cache_size": 512,
+        "semantic_cache_ttl": 86400
         }
     return config
 
+#Added for cheap cache-keys
+#   Query results carry a fingerprint (sql, schema-hash and row-count) in df.attrs, see
+#   VN_QsBase.execute_sql. Cached functions with a DataFrame-argument are keyed by it, so
+#   a result is never hashed row by row. Other frames are still hashed in full.
+def hash_dataframe(df: pd.DataFrame) -> str:
+    fingerprint = df.attrs.get('fingerprint')
+    if fingerprint is None:
+        df_hash = hashlib.sha1(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+        df_hash.update(str(list(df.columns)).encode())
+        return df_hash.hexdigest()
+    # A selection of columns or rows keeps the attrs of the result
+    return fingerprint + ':' + str([str(col) for col in df.columns]) + ':' + str(len(df))
+
+DF_HASH_FUNCS = {pd.DataFrame: hash_dataframe}
+
 #VannaStreamlit
+#   The VN_QsBase of setup_vanna() holds the shared parts (qdrant-client, fastembed-model,
+#   openai-client, connection-pool and caches). Every browser session gets its own
+#   lightweight copy from get_vanna() with its own history and selected database.
 @st.cache_resource(ttl=3600)
 def setup_vanna():
     vn = VN_QsBase(config=get_config())
-    vn.connect_to_sqlite(st.secrets.get('dbLoc') + '/Chinook/Chinook.sqlite')
+    vn.connect_to_sqlite_pool('Chinook')
     return vn
 
+def get_vanna():
+    if "vn" not in st.session_state:
+        st.session_state["vn"] = setup_vanna().new_user_context('Chinook')
+    return st.session_state["vn"]
+
+def get_history_key(vn) -> str:
+    # The prompts only see the last turns and the memory, the cached functions are keyed by them instead of the session
+    turns = vn._session.get_window(vn.history_window)
+    history = [(turn.question, turn.query, turn.summary) for turn in turns] + vn._session.get_memory()
+    return hashlib.sha1(str(history).encode()).hexdigest()
+
+#Added for the semantic cache
+#   Not cleared by st.cache_data.clear(), answers survive a 'New Chat'.
+@st.cache_resource(ttl=3600)
+def get_semantic_cache():
+    vn = setup_vanna()
+    config = get_config()
+    return SemanticCache(
+        vn.generate_embedding,
+        threshold=config.get("semantic_cache_threshold"),
+        max_entries=config.get("semantic_cache_size"),
+        ttl=config.get("semantic_cache_ttl")
+    )
+
+def is_standalone_question(vn=None):
+    # Follow-up questions depend on the conversation and are never answered from the cache
+    vn = vn or get_vanna()
+    return vn._session.get_num_turns() <= 1
+
+def generate_interpretation(question: str, vn=None):
+    vn = vn or get_vanna()
+    standalone = is_standalone_question(vn)
+    if standalone:
+        try:
+            entry = get_semantic_cache().lookup(question, vn.get_ddl_epoch())
+        except Exception as e:
+            print('Semantic cache lookup failed: ' + str(e))
+            entry = None
+        if entry is not None and entry.get('plan'):
+            return entry['plan'], entry.get('alternatives')
+
+    plan, alternatives = generate_interpretation_cached(vn, question, get_history_key(vn))
+    if standalone and plan:
+        try:
+            get_semantic_cache().store(question, vn.get_ddl_epoch(), plan=plan, alternatives=alternatives)
+        except Exception as e:
+            print('Semantic cache store failed: ' + str(e))
+    return plan, alternatives
+
+def generate_sql(question: str, plan: str, vn=None):
+    vn = vn or get_vanna()
+    standalone = is_standalone_question(vn)
+    if standalone:
+        try:
+            entry = get_semantic_cache().lookup(question, vn.get_ddl_epoch())
+        except Exception as e:
+            print('Semantic cache lookup failed: ' + str(e))
+            entry = None
+        if entry is not None and entry.get('sql') and entry.get('plan') == plan:
+            vn._session.add_sqlToLastTurn(entry['sql'])
+            return entry['sql']
+
+    # The session is updated here, a cache-hit of generate_sql_cached must update it as well
+    response, is_sql = generate_sql_cached(vn, question, plan, get_history_key(vn), vn.db_id)
+    if is_sql:
+        vn._session.add_sqlToLastTurn(response)
+
+    if standalone and is_sql and vn.get_cached_result(response, vn.db_id) is not None:
+        # Only SQL that was executed successfully is stored
+        try:
+            get_semantic_cache().store(question, vn.get_ddl_epoch(), plan=plan, sql=response)
+        except Exception as e:
+            print('Semantic cache store failed: ' + str(e))
+    return response
+
+#Added for the question bank
+#   Validated suggestions with their plan and SQL, filled in the background per schema.
+@st.cache_resource(ttl=3600)
+def get_question_bank():
+    return QuestionBank(setup_vanna())
+
+# Runs once per process and database, a changed schema is picked up by get_suggested_questions
+@st.cache_resource(ttl=3600)
+def prefill_question_bank(db_id: str):
+    try:
+        get_question_bank().prefill(db_id)
+    except Exception as e:
+        print('Question bank prefill failed: ' + str(e))
+
+def get_suggested_questions(num: int = 5) -> list:
+    # Served from the bank, questions are only generated live while it is still empty
+    vn = get_vanna()
+    try:
+        entries = get_question_bank().get_questions(vn.db_id, num)
+    except Exception as e:
+        print('Question bank lookup failed: ' + str(e))
+        entries = []
+    if len(entries) > 0:
+        return [entry['question'] for entry in entries]
+    return generate_questions_cached()[:num]
+
+def get_banked_question(question: str) -> dict:
+    vn = get_vanna()
+    try:
+        return get_question_bank().get_entry(vn.db_id, question)
+    except Exception as e:
+        print('Question bank lookup failed: ' + str(e))
+        return None
+
 #@st.cache_data(show_spinner="Generating sample questions ...")
 def generate_questions_cached():
-    vn = setup_vanna()
+    vn = get_vanna()
     try:
         questions = vn.generate_questions()
     except:
@@ -51,39 +196,41 @@ def generate_questions_cached():
     return questions
 
 @st.cache_data(show_spinner="Interpretating question ...")
-def generate_interpretation_cached(question: str):
-    vn = setup_vanna()
+def generate_interpretation_cached(_vn, question: str, history_key: str):
     try: 
-        plan, alternatives = vn.get_interpretation(question)
+        plan, alternatives = _vn.get_interpretation(question)
     except:
         plan, alternatives = None, None
     
     return plan, alternatives
 
 @st.cache_data(show_spinner="Generating SQL query ...")
-def generate_sql_cached(question: str, plan: str):
-    vn = setup_vanna()
-    sql, message = vn.generate_and_correct_sql(question, plan=plan, db_id='Chinook')
-    if message == "Not a text-to-sql-question":
-        try:
-            error_response = vn.generate_error_response(question,message)
-            vn._session.add_summaryToLastTurn(error_response)
-        except:
-            error_response = None
-        return error_response
-    else:
-        db_path= st.secrets.get('dbLoc') + '/Chinook/Chinook.sqlite'
-        executable, revised_sql, error = vn.check_sql_for_release(sql, db_path)
-        if executable:
-            vn._session.add_sqlToLastTurn(vn.extract_sql(sql))
-            return revised_sql
-        else:
-            try:
-                error_response = vn.generate_error_response(question,error)
-                vn._session.add_summaryToLastTurn(error_response)
-            except:
-                error_response = None
-            return error_response
+def generate_sql_cached(_vn, question: str, plan: str, history_key: str, db_id: str):
+    # Returns the SQL or the error message and whether it is SQL. The response to an
+    # error is generated (or streamed) by the caller, see generate_error_response.
+    sql, message = _vn.generate_and_correct_sql(question, plan=plan, db_id=db_id)
+    if message is not None:
+        # The SQL failed already in the correction, it isn't analyzed and executed again
+        return message, False
+    executable, revised_sql, error = _vn.check_sql_for_release(sql, db_id)
+    if executable:
+        return revised_sql, True
+    return error, False
+
+@st.cache_data(show_spinner="Generating error response ...")
+def generate_error_response_cached(_vn, question: str, message: str, history_key: str):
+    try:
+        error_response = _vn.generate_error_response(question,message)
+    except:
+        error_response = None
+    return error_response
+
+def generate_error_response(question: str, message: str):
+    vn = get_vanna()
+    error_response = generate_error_response_cached(vn, question, message, get_history_key(vn))
+    if error_response is not None:
+        vn._session.add_summaryToLastTurn(error_response)
+    return error_response
 
 @st.cache_data(show_spinner="Checking for valid SQL ...")
 def is_sql_valid_cached(sql: str):
@@ -91,20 +238,44 @@ def is_sql_valid_cached(sql: str):
     return vn.is_sql_valid(sql=sql)
 
 @st.cache_data(show_spinner="Running SQL query ...")
-def run_sql_cached(sql: str):
-    vn = setup_vanna()
+def run_sql_cached(_vn, sql: str, db_id: str):
     try:
-        df = vn.run_sql(sql=sql)
+        df = _vn.get_result(sql, db_id)
     except:
         df = None
     return df
 
-@st.cache_data(show_spinner="Checking if we should generate a chart ...")
+def get_result_page(sql: str, page: int, page_size: int):
+    vn = get_vanna()
+    handle = vn.get_result_handle(sql, vn.db_id)
+    if handle is None:
+        # The result came from the cache of another session or was evicted from this one
+        df, error = vn.execute_sql(sql, vn.db_id)
+        handle = vn.get_result_handle(sql, vn.db_id)
+        if handle is None:
+            return None
+    return handle.get_page(page, page_size)
+
+@st.cache_data(show_spinner="Checking if we should generate a chart ...", hash_funcs=DF_HASH_FUNCS)
 def should_generate_chart_cached(question, sql, df):
     vn = setup_vanna()
     return vn.should_generate_chart(df=df)
 
-@st.cache_data(show_spinner="Generating Plotly code ...")
+@st.cache_data(show_spinner="Planning chart ...", hash_funcs=DF_HASH_FUNCS)
+def plan_chart_cached(df):
+    vn = setup_vanna()
+    try:
+        value_cols = vn.get_value_columns(df)
+        # A single value is shown as an Indicator, should_generate_chart only accepts several rows
+        if not is_single_value(df, value_cols) and not vn.should_generate_chart(df):
+            return None
+        chart = plan_chart(df, value_cols)
+    except Exception as e:
+        print('Chart planning failed: ' + str(e))
+        chart = None
+    return chart
+
+@st.cache_data(show_spinner="Generating Plotly code ...", hash_funcs=DF_HASH_FUNCS)
 def generate_plotly_code_cached(question, sql, df):
     vn = setup_vanna()
     try:
@@ -113,7 +284,7 @@ def generate_plotly_code_cached(question, sql, df):
         code = ''
     return code
 
-@st.cache_data(show_spinner="Running Plotly code ...")
+@st.cache_data(show_spinner="Running Plotly code ...", hash_funcs=DF_HASH_FUNCS)
 def generate_plot_cached(code, df):
     vn = setup_vanna()
     try:
@@ -122,7 +293,7 @@ def generate_plot_cached(code, df):
         fig = None
     return fig
 
-@st.cache_data(show_spinner="Generating followup questions ...")
+@st.cache_data(show_spinner="Generating followup questions ...", hash_funcs=DF_HASH_FUNCS)
 def generate_followup_cached(question, sql, df):
     vn = setup_vanna()
     return vn.generate_followup_questions(question=question, sql=sql, df=df)
@@ -136,23 +307,167 @@ def generate_interpretation_respond_cached(question, plan):
         interpretation = None
     return interpretation
 
-@st.cache_data(show_spinner="Generating summary ...")
+@st.cache_data(show_spinner="Generating summary ...", hash_funcs=DF_HASH_FUNCS)
 def generate_summary_cached(question, df, alternatives):
     vn = setup_vanna()
     try:
         summary = vn.generate_summary(question, df, alternatives=alternatives)
-        vn._session.add_summaryToLastTurn(summary)
     except:
         summary = None
     return summary
 
+def generate_summary(question, df, alternatives, vn=None):
+    vn = vn or get_vanna()
+    summary = generate_summary_cached(question, df, alternatives)
+    if summary is not None:
+        vn._session.add_summaryToLastTurn(summary)
+    return summary
+
+#Added for streaming
+#   The assembled text of a finished stream is kept, so a repeated call is answered at once.
+#   Like st.cache_data, the texts are shared between sessions and cleared by clear_stream_cache().
+#   The least recently used texts are dropped beyond STREAM_CACHE_SIZE. A failed stream
+#   raises and keeps nothing, its partial text is neither cached nor added to the turn.
+STREAM_CACHE_SIZE = 256
+
+@st.cache_resource
+def get_stream_cache():
+    return OrderedDict(), threading.Lock()
+
+def clear_stream_cache():
+    cache, lock = get_stream_cache()
+    with lock:
+        cache.clear()
+
+def get_df_key(df: pd.DataFrame) -> str:
+    if df is None:
+        return None
+    return hash_dataframe(df)
+
+def stream_cached(key, stream_fn, on_complete=None):
+    cache, lock = get_stream_cache()
+    with lock:
+        text = cache.get(key)
+        if text is not None:
+            cache.move_to_end(key)
+
+    if text is not None:
+        yield text
+    else:
+        chunks = []
+        for chunk in stream_fn():
+            chunks.append(chunk)
+            yield chunk
+        text = ''.join(chunks)
+        with lock:
+            cache[key] = text
+            while len(cache) > STREAM_CACHE_SIZE:
+                cache.popitem(last=False)
+
+    if on_complete is not None:
+        on_complete(text)
+
+def generate_summary_stream(question, df, alternatives):
+    vn = get_vanna()
+    key = ('summary', question, get_df_key(df), str(alternatives))
+    return stream_cached(
+        key,
+        lambda: vn.generate_summary_stream(question, df, alternatives=alternatives),
+        on_complete=vn._session.add_summaryToLastTurn
+    )
+
+def generate_interpretation_respond_stream(question, plan):
+    vn = setup_vanna()
+    key = ('interpretation_respond', question, plan)
+    return stream_cached(key, lambda: vn.genenerate_interpretation_respond_stream(question, plan))
+
+def generate_sql_explanation_on_demand_stream(sql, related_question):
+    vn = setup_vanna()
+    key = ('sql_explanation', sql, related_question)
+    return stream_cached(key, lambda: vn.generate_sql_explanation_on_demand_stream(sql, related_question))
+
+def generate_error_response_stream(question, message):
+    vn = get_vanna()
+    key = ('error_response', question, message)
+    return stream_cached(
+        key,
+        lambda: vn.generate_error_response_stream(question, message),
+        on_complete=vn._session.add_summaryToLastTurn
+    )
+
+#Added for parallel stages
+#   interpretation -> (interpretation_respond | sql -> df -> (chart | summary))
+#   A banked question brings its plan and SQL along, both stages return them directly.
+#   With stream_text the interpretation_respond and summary stages are left to the caller,
+#   which streams them while the other stages keep running in the background.
+def build_response_pipeline(question, show_interpretation=True, show_chart=True, show_summary=True, fallback_df=None, stream_text=False, banked=None):
+    # The worker-threads need the script-context of the session to use the st.cache_data functions
+    ctx = get_script_run_ctx()
+    vn = get_vanna()
+    pipeline = StagePipeline(initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx))
+
+    def interpretation():
+        if banked is not None:
+            return banked['plan'], banked.get('alternatives')
+        return generate_interpretation(question, vn)
+
+    def interpretation_respond(interpretation):
+        plan, alternatives = interpretation
+        if plan and show_interpretation and not stream_text:
+            return generate_interpretation_respond_cached(question, plan)
+        return None
+
+    def sql(interpretation):
+        plan, alternatives = interpretation
+        if banked is not None:
+            # The SQL of a banked question was validated already
+            vn._session.add_sqlToLastTurn(banked['sql'])
+            return banked['sql']
+        return generate_sql(question, plan, vn)
+
+    def df(sql):
+        if not sql or not is_sql_valid_cached(sql):
+            return None
+        result = run_sql_cached(vn, sql, vn.db_id)
+        if result is None:
+            return fallback_df
+        return result
+
+    def chart(sql, df):
+        if df is None or not show_chart:
+            return None, None
+        # Common shapes are charted by rules, only the others cost an LLM round-trip
+        planned = plan_chart_cached(df)
+        if planned is not None:
+            return planned
+        if not should_generate_chart_cached(question, sql, df):
+            return None, None
+        code = generate_plotly_code_cached(question, sql, df)
+        if code is None or code == "":
+            return code, None
+        return code, generate_plot_cached(code, df)
+
+    def summary(interpretation, df):
+        plan, alternatives = interpretation
+        if df is None or not show_summary or stream_text:
+            return None
+        return generate_summary(question, df, alternatives, vn)
+
+    pipeline.add_stage("interpretation", interpretation)
+    pipeline.add_stage("interpretation_respond", interpretation_respond, ["interpretation"])
+    pipeline.add_stage("sql", sql, ["interpretation"])
+    pipeline.add_stage("df", df, ["sql"])
+    pipeline.add_stage("chart", chart, ["sql", "df"])
+    pipeline.add_stage("summary", summary, ["interpretation", "df"])
+    return pipeline
+
 #Added for multi-turn-functionanlity
 def setUp_newVS():
-    vn = setup_vanna()
+    vn = get_vanna()
     vn.setUp_newSession()
 
 def add_turn_to_history(question:str):
-    vn = setup_vanna()
+    vn = get_vanna()
     vn._session.add_turnToHistory({'question':question,'query': None, 'summary': None})
 
 # Save chat history to shelve file
@@ -160,32 +475,37 @@ def add_turn_to_history(question:str):
     #with shelve.open(sessionName) as db:
         #db["messages"] = messages
 
-def read_file(file):
-    f = open(file, 'r', encoding='utf-8')
-    return f.read()
+#Added for the ER-diagram
+@st.cache_resource
+def get_er_diagram_cache():
+    return ERDiagramCache(setup_vanna()._pool)
 
-st.cache_data(show_spinner="Loading tables")
-def get_tableString(db_name):
-    vn = setup_vanna()
-    vn.connect_to_sqlite(st.secrets.get("dbLoc") + '/' + db_name + '/' + db_name + '.sqlite')
-    tbl_df = vn.run_sql("SELECT tbl_name FROM sqlite_master WHERE sql is not null and type = 'table' and tbl_name not like '%sqlite%' ")
-    tbl_list = tbl_df['tbl_name'].to_list()
-    return str(tbl_list).replace('[','(').replace(']',')')
+def get_er_diagram(db_name: str, left_to_right: bool = False) -> str:
+    return get_er_diagram_cache().get(db_name, left_to_right)
+
+#Added for the table-browser
+@st.cache_resource
+def get_table_browser():
+    # Shared with the SQL-analysis of VN_QsBase, which uses the same row-counts
+    return setup_vanna()._table_browser
+
+def get_table_list(db_name):
+    return get_table_browser().get_tables(db_name)
 
 def override_current_tbl(tbl_name):
     data = get_runtimeParams()
     data['current_tbl'] = tbl_name
-    f = open('./.streamlit/runtimeParams.toml','w')
-    toml.dump(data, f)
-    f.close()
-    #st.cache_resource.clear()
-    print('current_tbl in runtimeParams has been overridden to ' + tbl_name)
+    print('current_tbl of this session has been overridden to ' + tbl_name)
 
-def get_tbl_df(tbl_name: str, db_name: str):
-    vn = setup_vanna()
-    vn.connect_to_sqlite(st.secrets.get("dbLoc") + '/' + db_name + '/' + db_name + '.sqlite')
-    tbl_df = vn.run_sql('SELECT * FROM ' + tbl_name + ' LIMIT 10')
-    return tbl_df
+def get_tbl_df(tbl_name: str, db_name: str, after: tuple = None):
+    # Returns a page of the table and the key of the next page
+    return get_table_browser().get_page(db_name, tbl_name, after)
+
+def get_tbl_row_count(tbl_name: str, db_name: str):
+    return get_table_browser().get_row_count(db_name, tbl_name)
+
+def get_tbl_column_stats(tbl_name: str, db_name: str):
+    return get_table_browser().get_column_stats(db_name, tbl_name)
 
 def setUp_newTable(tbl_name: str):
     current_tbl = get_runtimeParams()['current_tbl']
@@ -193,12 +513,18 @@ def setUp_newTable(tbl_name: str):
         return 'You are already connected to ' + tbl_name
     else:
         override_current_tbl(tbl_name)
-        st.cache_data.clear()
         return 'Connection to *' + tbl_name + '* was established'
 
+#Added for the runtime-settings
+@st.cache_resource
+def get_runtime_settings():
+    return RuntimeSettings('./.streamlit/runtimeParams.toml')
+
 def get_runtimeParams():
-    data = toml.load('./.streamlit/runtimeParams.toml')
-    return data
+    return get_runtime_settings().get_session_settings(st.session_state)
+
+def persist_runtimeParams():
+    get_runtime_settings().persist_defaults(get_runtimeParams())
 
 def get_last_df(messages):
     last_df = next((item["content"] for item in reversed(messages) if item.get("type") == "dataframe"), None)
@@ -215,8 +541,7 @@ def get_last_num_column_string(messages):
     vn = setup_vanna()
     df = get_last_df(messages)
     if df is not None and vn.should_generate_chart(df):
-        num_columns = list(df.select_dtypes(include=['number']))
-        non_id_columns = [col for col in num_columns if not col.lower().endswith("id")]
+        non_id_columns = vn.get_value_columns(df)
         return str(non_id_columns).replace('[','(').replace(']',')')
     else:
         return '()'
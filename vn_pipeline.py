@@ -0,0 +1,107 @@
+import threading
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+
+# Pipeline-Modul
+#   The stages of a turn form a dependency graph. A stage is submitted as soon as
+#   all stages it depends on are finished, so independent stages (e.g. chart and
+#   summary) run at the same time. Results are read back in any order with result().
+class StagePipeline():
+    def __init__(self, max_workers: int = 4, initializer=None):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, initializer=initializer)
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._futures = {}
+        self._submitted = set()
+        self._started = False
+
+    def add_stage(self, name: str, fn, depends_on: list = None):
+        # fn is called with the results of its dependencies as keyword-arguments
+        if name in self._stages:
+            raise ValueError('Stage ' + name + ' was already added')
+        for dependency in depends_on or []:
+            if dependency not in self._stages:
+                raise ValueError('Unknown dependency ' + dependency + ' for stage ' + name)
+
+        self._stages[name] = (fn, list(depends_on or []))
+        self._futures[name] = Future()
+        return self
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return self
+            self._started = True
+
+        for name, (fn, depends_on) in self._stages.items():
+            if len(depends_on) == 0:
+                self._submit(name)
+            else:
+                for dependency in depends_on:
+                    self._futures[dependency].add_done_callback(lambda _, name=name: self._on_dependency_done(name))
+        return self
+
+    def result(self, name: str, timeout: float = None):
+        if not self._started:
+            self.start()
+        return self._futures[name].result(timeout=timeout)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        for future in self._futures.values():
+            if not future.done():
+                future.cancel()
+
+    def _on_dependency_done(self, name: str):
+        fn, depends_on = self._stages[name]
+        if not all(self._futures[dependency].done() for dependency in depends_on):
+            return
+
+        if not self._mark_submitted(name):
+            return
+
+        for dependency in depends_on:
+            dependency_future = self._futures[dependency]
+            if dependency_future.cancelled():
+                self._futures[name].set_exception(CancelledError(dependency + ' was cancelled'))
+                return
+            error = dependency_future.exception()
+            if error is not None:
+                self._futures[name].set_exception(error)
+                return
+
+        self._run_in_executor(name)
+
+    def _submit(self, name: str):
+        if self._mark_submitted(name):
+            self._run_in_executor(name)
+
+    def _mark_submitted(self, name: str) -> bool:
+        # Every dependency triggers a callback, the stage must still be submitted only once
+        with self._lock:
+            if name in self._submitted:
+                return False
+            self._submitted.add(name)
+        return self._futures[name].set_running_or_notify_cancel()
+
+    def _run_in_executor(self, name: str):
+        try:
+            self._executor.submit(self._run, name)
+        except RuntimeError as e:
+            # The pipeline was shut down before this stage became ready
+            self._futures[name].set_exception(e)
+
+    def _run(self, name: str):
+        fn, depends_on = self._stages[name]
+        future = self._futures[name]
+        try:
+            kwargs = {dependency: self._futures[dependency].result() for dependency in depends_on}
+            future.set_result(fn(**kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+        return False
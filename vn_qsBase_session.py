@@ -2,17 +2,28 @@ from vanna.qdrant import Qdrant_VectorStore
 from vanna.openai import OpenAI_Chat
 
 from vanna.types import TrainingPlan
+from vanna.utils import deterministic_uuid
+from qdrant_client import models
 from dotenv import load_dotenv
 import os
 
-import sqlite3
 import pandas as pd
 
 from vn_session import VN_session
-import openai_cookbook as oc
+from sqlite_pool import SQLitePool
+from ddl_cache import DDLCache
+from prompt_builder import PromptBuilder, DataFrameContext
+from response_parser import parse_correction, parse_interpretation, parse_question_list
+from table_browser import TableBrowser
+from sql_analyzer import SQLAnalyzer
+from result_store import ResultStore, ResultHandle
+from plot_worker import PlotWorkerPool
 
 import re
-import ast
+import hashlib
+import copy
+import threading
+from collections import OrderedDict
 
 load_dotenv('.env')
 
@@ -21,8 +32,53 @@ class VN_QsBase(Qdrant_VectorStore, OpenAI_Chat):
         Qdrant_VectorStore.__init__(self, config=config)
         OpenAI_Chat.__init__(self, config=config)
 
-        self._session = VN_session()
+        self.session_max_turns = config.get("session_max_turns", 20)
+        self.history_window = config.get("history_window", 5)
+        self.history_tokens = config.get("history_tokens", 1500)
+        self.memory_tokens = config.get("memory_tokens", 500)
+        self._session = self.new_session()
+        self.db_id = None
         self.model = config.get("model")
+        self.max_result_rows = config.get("max_result_rows", 100000)
+        self.result_cache_size = config.get("result_cache_size", 16)
+        self._result_cache = OrderedDict()
+        self._result_lock = threading.Lock()
+        self._prompt_stats = {}
+        self._prompt_stats_lock = threading.Lock()
+
+        self._pool = SQLitePool(
+            config.get("db_loc", os.getenv('dbLoc')),
+            max_connections=config.get("max_db_connections", 8),
+            immutable=config.get("db_immutable", ()),
+            query_timeout=config.get("query_timeout", 10),
+        )
+        self._result_store = ResultStore(
+            max_rows=self.max_result_rows,
+            max_bytes=config.get("max_result_bytes", 268435456),
+            preview_rows=config.get("result_preview_rows", 1000),
+        )
+        self._ddl_cache = DDLCache(self._load_all_ddl)
+        self._table_browser = TableBrowser(self._pool)
+        self._plot_workers = PlotWorkerPool(
+            max_workers=config.get("plot_workers", 2),
+            timeout=config.get("plot_timeout", 10),
+            max_memory=config.get("plot_max_memory", 2147483648),
+        ) if config.get("plot_in_worker", True) else None
+        self._sql_analyzer = SQLAnalyzer(
+            self._pool,
+            self._table_browser,
+            max_query_cost=config.get("max_query_cost", 10000000),
+        )
+        self.completion_tokens = config.get("completion_tokens", 4096)
+        self.summary_representation = config.get("summary_representation", "markdown")
+        self.summary_max_rows = config.get("summary_max_rows", 100)
+        self.summary_with_stats = config.get("summary_with_stats", True)
+        self.json_mode = config.get("json_mode", False)
+        self.correction_attempts = config.get("correction_attempts", 1)
+        self.correction_candidates = config.get("correction_candidates", 3)
+        self.schema_linking_limit = config.get("schema_linking_limit", self.n_results)
+        self.schema_linking_keyword_results = config.get("schema_linking_keyword_results", 2)
+        self.schema_linking_max_keywords = config.get("schema_linking_max_keywords", 8)
 
 
     # Prompt-Modul
@@ -53,17 +109,109 @@ class VN_QsBase(Qdrant_VectorStore, OpenAI_Chat):
     
         return result
     
-    def get_exampleValues(self, tbl_name, db_name) -> str:
-        self.connect_to_sqlite(os.getenv('dbLoc') + '/' + db_name + '/' + db_name + '.sqlite')
-        sql = 'SELECT * FROM ' + tbl_name + ' ORDER BY RANDOM() LIMIT 2'
-        example_dict = self.run_sql(sql).to_dict('list')
+    def get_exampleValues(self, tbl_name, db_name, num_examples: int = 2) -> str:
+        example_dict = self.get_sample_rows(tbl_name, db_name, num_examples).to_dict('list')
         return 'Value-Examples: ' + str(example_dict).replace('{', '').replace('}', '')
 
+    def get_sample_rows(self, tbl_name, db_name, num_examples: int = 2) -> pd.DataFrame:
+        # Rows at evenly spaced rowids, each found by an index-seek instead of sorting the whole table.
+        # The same table always gives the same examples.
+        quoted_name = '"' + tbl_name.replace('"', '""') + '"'
+        try:
+            bounds = self.run_sql_on(db_name, 'SELECT min(rowid), max(rowid) FROM ' + quoted_name)
+        except Exception:
+            # WITHOUT ROWID tables are sampled in the order of their primary-key
+            return self.run_sql_on(db_name, 'SELECT * FROM ' + quoted_name + ' LIMIT ' + str(int(num_examples)))
+
+        min_rowid, max_rowid = bounds.iloc[0, 0], bounds.iloc[0, 1]
+        if pd.isna(min_rowid):
+            return self.run_sql_on(db_name, 'SELECT * FROM ' + quoted_name + ' LIMIT 0')
+
+        positions = sorted(set(int(min_rowid + (max_rowid - min_rowid) * (i + 1) / (num_examples + 1)) for i in range(num_examples)))
+        sql = ' UNION ALL '.join(
+            'SELECT * FROM (SELECT * FROM ' + quoted_name + ' WHERE rowid >= ' + str(position) + ' ORDER BY rowid LIMIT 1)'
+            for position in positions
+        )
+        return self.run_sql_on(db_name, sql)
+
     def add_ddl(self, ddl: str, **kwargs) -> str:
         schema = self.convert_ddlToSchema(ddl)
         exampleValues = self.get_exampleValues(kwargs.get('tbl_name'), kwargs.get('db_name'))
         schema += ' \n' + exampleValues
-        return super().add_ddl(schema)
+        id = super().add_ddl(schema)
+        self._ddl_cache.add(id, schema)
+        return id
+
+    # Training-Modul
+    #   Trains all tables of a database at once: the schemas are embedded in one batched
+    #   pass and upserted in batches. The payload keeps the table and a hash of its DDL,
+    #   so tables whose DDL hasn't changed since the last run are skipped. Points of add_ddl
+    #   have no such payload, they are recognized by their schema and replaced. Points of
+    #   tables that were dropped from the database are deleted.
+    def train_schema(self, db_name: str, batch_size: int = 64, num_examples: int = 2) -> dict:
+        tables = self.run_sql_on(db_name, "SELECT tbl_name, sql FROM sqlite_master WHERE sql is not null and type = 'table' and tbl_name not like '%sqlite%' ORDER BY tbl_name")
+
+        trained = {}
+        legacy = {}
+        for point in self._get_all_points(self.ddl_collection_name):
+            if point.payload.get("tbl_name") is None:
+                # The schema without the example values
+                legacy.setdefault(point.payload.get("ddl", "").split(' \n')[0], []).append(point.id)
+            elif point.payload.get("db_name") == db_name:
+                trained[point.payload["tbl_name"]] = (point.id, point.payload.get("ddl_hash"))
+
+        new_points = []
+        old_ids = []
+        for tbl_name, ddl in tables.itertuples(index=False, name=None):
+            ddl_hash = hashlib.sha1(ddl.encode()).hexdigest()
+            schema = self.convert_ddlToSchema(ddl)
+            old_ids.extend(legacy.get(schema, []))
+            if tbl_name in trained:
+                point_id, trained_hash = trained.pop(tbl_name)
+                if trained_hash == ddl_hash:
+                    continue
+                old_ids.append(point_id)
+
+            schema += ' \n' + self.get_exampleValues(tbl_name, db_name, num_examples)
+            new_points.append((deterministic_uuid(schema), schema, {"tbl_name": tbl_name, "db_name": db_name, "ddl_hash": ddl_hash}))
+
+        # What is left in trained, is no longer in the database
+        dropped_ids = [point_id for point_id, trained_hash in trained.values()]
+        old_ids.extend(dropped_ids)
+
+        embeddings = self.generate_embeddings([schema for point_id, schema, payload in new_points])
+        for start in range(0, len(new_points), batch_size):
+            batch = list(zip(new_points, embeddings))[start:start + batch_size]
+            self._client.upsert(
+                self.ddl_collection_name,
+                points=[
+                    models.PointStruct(id=point_id, vector=embedding, payload=dict(payload, ddl=schema))
+                    for (point_id, schema, payload), embedding in batch
+                ],
+            )
+            for (point_id, schema, payload), embedding in batch:
+                self._ddl_cache.add(self._format_point_id(point_id, self.ddl_collection_name), schema)
+
+        new_ids = set(point_id for point_id, schema, payload in new_points)
+        old_ids = [point_id for point_id in old_ids if point_id not in new_ids]
+        if len(old_ids) > 0:
+            self._client.delete(self.ddl_collection_name, points_selector=old_ids)
+            for point_id in old_ids:
+                self._ddl_cache.remove(self._format_point_id(point_id, self.ddl_collection_name))
+
+        return {"trained": len(new_points), "removed": len(old_ids), "dropped": len(dropped_ids), "unchanged": len(tables) - len(new_points)}
+
+    def remove_training_data(self, id: str, **kwargs) -> bool:
+        removed = super().remove_training_data(id, **kwargs)
+        if removed and id.endswith('-' + self.id_suffixes[self.ddl_collection_name]):
+            self._ddl_cache.remove(id)
+        return removed
+
+    def remove_collection(self, collection_name: str) -> bool:
+        removed = super().remove_collection(collection_name)
+        if removed and collection_name == self.ddl_collection_name:
+            self._ddl_cache.invalidate()
+        return removed
     
     def train(
         self,
@@ -90,7 +238,7 @@ class VN_QsBase(Qdrant_VectorStore, OpenAI_Chat):
         question_sql_list: list,
         ddl_list: list,
         doc_list: list,
-        utterance_list: list,
+        history_messages: list,
         **kwargs,
     ):
         """
@@ -112,6 +260,7 @@ class VN_QsBase(Qdrant_VectorStore, OpenAI_Chat):
             question_sql_list (list): A list of questions and their corresponding SQL statements.
             ddl_list (list): A list of DDL statements.
             doc_list (list): A list of documentation.
+            history_messages (list): The rendered messages of the past turns, see get_history_messages().
 
         Returns:
             any: The prompt for the LLM to generate SQL.
@@ -120,48 +269,41 @@ class VN_QsBase(Qdrant_VectorStore, OpenAI_Chat):
         if initial_prompt is None:
             initial_prompt = f"You are a {self.dialect} expert. Generate {self.dialect} SQL query only and with no explanation. Instead of '*' always name all the columns. If there are duplicate column names, use aliases by using the table-name as a prefix with an '_' as a seperator. \n"
 
-        initial_prompt = self.add_ddl_to_prompt(
-            initial_prompt, ddl_list, max_tokens=self.max_tokens
-        )
+        builder = self.get_prompt_builder()
+        closing_messages = [
+            self.system_message(f"The System has interpreted the user-question as:\n'{kwargs.get('plan')}'\n\n. Based on that interpretation, generate a SQL-Query for the following:"),
+            self.user_message(question),
+        ]
+        closing_tokens = builder.count_messages(closing_messages)
+        builder.reserve(closing_tokens)
 
-        if self.static_documentation != "":
-            doc_list.append(self.static_documentation)
+        builder.append(initial_prompt)
+        self.add_ddl_to_builder(builder, ddl_list)
 
-        initial_prompt = self.add_documentation_to_prompt(
-            initial_prompt, doc_list, max_tokens=self.max_tokens
-        )
+        # The static documentation belongs to the stable prefix and comes before the related documentation
+        if self.static_documentation != "":
+            doc_list = [self.static_documentation] + [doc for doc in doc_list if doc != self.static_documentation]
 
-        message_log = [self.system_message(initial_prompt)]
+        builder.append_items("\n===Additional Context \n\n", doc_list, item_format="{}\n\n", max_tokens=self.max_tokens)
+        builder.flush_system()
 
         if len(question_sql_list) > 0:
-            message_log.append(self.system_message('Some example questions and corresponding SQL queries are provided based on similar problems:'))
+            builder.add_system('Some example questions and corresponding SQL queries are provided based on similar problems:')
 
         for example in question_sql_list:
             if example is None:
                 print("example is None")
             else:
                 if example is not None and "question" in example and "sql" in example:
-                    message_log.append(self.user_message(example["question"]))
-                    message_log.append(self.assistant_message(example["sql"]))
+                    builder.add_example(example["question"], example["sql"])
 
-        if len(utterance_list) > 0:
-            message_log.append(self.system_message('Past interactions in this session: '))
-        
-        for utterance in utterance_list:
-            if utterance is None:
-                print("no history")
-            else:
-                if utterance is not None and "question" in utterance and "query" in utterance:
-                    message_log.append(self.user_message(utterance["question"]))
-                    if utterance["query"] is not None:
-                        message_log.append(self.assistant_message(utterance["query"]))
-                    if utterance["summary"] is not None:
-                        message_log.append(self.assistant_message("Result-Summary: " + utterance["summary"]))
+        self.add_memory_to_builder(builder, max_tokens=self.memory_tokens)
+        self.add_history_to_builder(builder, history_messages, max_tokens=self.history_tokens)
         
-        message_log.append(self.system_message(f"The System has interpreted the user-question as:\n'{kwargs.get('plan')}'\n\n. Based on that interpretation, generate a SQL-Query for the following:"))
-        message_log.append(self.user_message(question))
+        builder.release(closing_tokens)
+        builder.add_messages(closing_messages, force=True)
 
-        return message_log
+        return builder.get_messages()
     
     def add_ddl_to_prompt(
         self, initial_prompt: str, ddl_list: list[str], max_tokens: int = 14000
@@ -169,98 +311,264 @@ class VN_QsBase(Qdrant_VectorStore, OpenAI_Chat):
         if len(ddl_list) > 0:
             initial_prompt += '\n' + f"{self.dialect} SQL tables, with their properties:\n\n"
 
+            num_tokens = self.str_to_approx_token_count(initial_prompt)
             for ddl in ddl_list:
-                if (
-                    self.str_to_approx_token_count(initial_prompt)
-                    + self.str_to_approx_token_count(ddl)
-                    < max_tokens
-                ):
+                ddl_tokens = self.str_to_approx_token_count(ddl)
+                if num_tokens + ddl_tokens < max_tokens:
                     initial_prompt += f"{ddl}\n"
+                    num_tokens += ddl_tokens
 
         return initial_prompt
-    """
+
+    ## Token-budgeted prompt assembly
+    def get_prompt_budget(self) -> int:
+        context_window = self.get_context_window(self.model)
+        if context_window is None:
+            return self.max_tokens
+        return context_window - self.completion_tokens
+
+    def get_prompt_builder(self) -> PromptBuilder:
+        return PromptBuilder(self.model, self.get_prompt_budget(), self.system_message, self.user_message, self.assistant_message)
+
+    def add_ddl_to_builder(self, builder: PromptBuilder, ddl_list: list[str]):
+        # The DDL that fits is chosen in ranked order, only the chosen ones are sorted,
+        # so the same tables always give the same prompt-prefix
+        header = '\n' + f"{self.dialect} SQL tables, with their properties:\n\n"
+        section_tokens = builder.count(header)
+        remaining = builder.remaining() - section_tokens
+        selected = []
+        for ddl in ddl_list:
+            tokens = builder.count(ddl + '\n')
+            if section_tokens + tokens >= self.max_tokens or tokens > remaining:
+                continue
+            selected.append(ddl)
+            section_tokens += tokens
+            remaining -= tokens
+        builder.append_items(header, sorted(selected), max_tokens=self.max_tokens)
+
+    def add_history_to_builder(self, builder: PromptBuilder, history_messages: list, max_tokens: int = None):
+        # The most recent turns that fit into max_tokens are kept
+        selected = []
+        num_tokens = 0
+        for turn_messages in reversed(history_messages):
+            turn_tokens = builder.count_messages(turn_messages)
+            if max_tokens is not None and num_tokens + turn_tokens > max_tokens:
+                break
+            selected.insert(0, turn_messages)
+            num_tokens += turn_tokens
+
+        if len(selected) > 0:
+            builder.add_system('Past interactions in this session: ')
+        
+        for turn_messages in selected:
+            builder.add_messages(turn_messages)
+
+    def add_memory_to_builder(self, builder: PromptBuilder, max_tokens: int = None):
+        # Turns older than the history-window, in one line each and newest first within max_tokens
+        memory = self._session.get_memory()
+        if len(memory) == 0:
+            return
+
+        header = 'Earlier interactions in this session (compressed): \n'
+        num_tokens = builder.count(header)
+        selected = []
+        for line in reversed(memory):
+            line_tokens = builder.count(line)
+            if max_tokens is not None and num_tokens + line_tokens > max_tokens:
+                break
+            selected.insert(0, line)
+            num_tokens += line_tokens
+
+        if len(selected) > 0:
+            builder.add_system(header + ''.join(selected))
+
+    ## History Representation
+    #   The messages of the past turns are rendered once per change of the session and
+    #   then reused by every prompt of the turn.
+    def get_history_messages(self, window: int = None, include_last: bool = False) -> list:
+        window = self.history_window if window is None else window
+        return self._session.get_rendered(
+            ('messages', window, include_last),
+            lambda: [self.render_turn(turn) for turn in self._session.get_window(window, include_last)]
+        )
+
+    def render_turn(self, turn) -> list:
+        turn_messages = [self.user_message(turn.question)]
+        if turn.query is not None:
+            turn_messages.append(self.assistant_message(turn.query))
+        if turn.summary is not None:
+            turn_messages.append(self.assistant_message("Result-Summary: " + turn.summary))
+        return turn_messages
     # Schema-Linking-Modul
+    #   The question and its keywords are embedded in one batch and looked up with a single
+    #   query_batch_points request. The hits are merged per DDL and ranked by their best score.
+    stopwords = {
+        "a", "all", "an", "and", "any", "are", "as", "at", "be", "by", "can", "did", "do", "does", "each", "for",
+        "from", "give", "has", "have", "how", "i", "in", "is", "it", "list", "many", "me", "much", "most", "of",
+        "on", "or", "per", "show", "table", "than", "that", "the", "their", "there", "these", "this", "to", "top", "was",
+        "were", "what", "when", "where", "which", "who", "whose", "why", "with", "would", "you"
+    }
+
     def get_related_ddl(self, question: str, **kwargs) -> list:
-        keywordList = self.get_keywords(question)
-        ddl_list = []
-        for keyword in keywordList:
-            results = self._client.query_points(
-            self.ddl_collection_name,
-            query=self.generate_embedding(keyword),
-            limit=2,
-            with_payload=True,
-            ).points
-            result_list = [result.payload["ddl"] for result in results]
-            ddl_list.extend(result_list)
-
-        return list(set(ddl_list))
-
-    def get_keywords(self,question):
-        keywords = self.kw_model.extract_keywords(question)
-        res_list = [x[0] for x in keywords]
-        return res_list
-    """
-    
+        return [ddl for ddl, score in self.get_related_ddl_with_scores(question, **kwargs)]
+
+    def get_related_ddl_with_scores(self, question: str, **kwargs) -> list:
+        queries = [question] + self.get_keywords(question)
+        embeddings = self.generate_embeddings(queries)
+
+        # The question itself gets the full n_results, each keyword only its best hits
+        requests = [
+            models.QueryRequest(
+                query=embedding,
+                limit=self.n_results if i == 0 else self.schema_linking_keyword_results,
+                with_payload=True,
+            )
+            for i, embedding in enumerate(embeddings)
+        ]
+        responses = self._client.query_batch_points(self.ddl_collection_name, requests=requests)
+
+        scores = {}
+        for response in responses:
+            for point in response.points:
+                ddl = point.payload["ddl"]
+                if ddl not in scores or point.score > scores[ddl]:
+                    scores[ddl] = point.score
+
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        return ranked[:self.schema_linking_limit]
+
+    def get_keywords(self, question: str) -> list:
+        words = re.findall(r"[A-Za-z_][A-Za-z0-9_]*", question)
+        keywords = []
+        for word in words:
+            if len(word) > 2 and word.lower() not in self.stopwords and word.lower() not in keywords:
+                keywords.append(word.lower())
+        return keywords[:self.schema_linking_max_keywords]
+
+    def generate_embeddings(self, data: list) -> list:
+        embedding_model = self._client._get_or_init_model(model_name=self.fastembed_model)
+        return [embedding.tolist() for embedding in embedding_model.embed(data)]
+
     # Correction-Modul
-    def generate_and_correct_sql(self, question: str, **kwargs) -> str:
-        sql = self.generate_sql(question, **kwargs)
+    #   The schema-context is looked up once per question and shared by the generation and
+    #   the corrections. The first SQL is analyzed and executed once, its stored result is
+    #   reused on release. Only correction candidates are probed (compiled and the first row
+    #   fetched): a correction asks for several candidates in one completion and keeps the
+    #   first that returns a row, only that one is executed. With probe_only nothing is
+    #   executed, the first SQL is probed like the candidates.
+    def generate_and_correct_sql(self, question: str, probe_only: bool = False, **kwargs) -> str:
+        ddl_list = self.get_related_ddl(question)
+        sql = self.generate_sql(question, ddl_list=ddl_list, **kwargs)
         if not self.is_sql_valid(sql):
             return "", "Not a text-to-sql-question"
         
         db_id = kwargs.get('db_id')
-        db_path = os.getenv('dbLoc') + '/' + db_id + '/' + db_id + '.sqlite'
-        executable, message = self.check_sql(sql,db_path)
+        sql, message = self.analyze_sql(sql, db_id)
+        if message is None and probe_only:
+            executable, message = self.check_sql(sql, db_id)
+        elif message is None:
+            df, message = self.execute_sql(sql, db_id)
+            if message is None and df.attrs.get('num_rows', len(df)) == 0:
+                message = "sql returns no value"
+        # Queries that don't compile or are too costly go to the correction without running
+        executable = message is None
         
-        if executable:
-            return sql, message
-        else:
-            self.log(title="SQL Correction needed: 1. Attempt", message=message)
-            return self.correct_sql(question, sql, message, db_path, 1, **kwargs)
-
+        for attempt in range(1, self.correction_attempts + 1):
+            if executable:
+                break
+            self.log(title="SQL Correction needed: " + str(attempt) + ". Attempt", message=message)
+            sql, message = self.correct_sql(question, sql, message, ddl_list=ddl_list, **kwargs)
+            if message is None and not probe_only:
+                df, message = self.execute_sql(sql, db_id)
+            executable = message is None
+
+        return sql, message
+
+    def check_sql(self,predicted_sql,db_id):
+        if predicted_sql is None:
+            return False, "no sql to execute"
+        if self.get_cached_result(predicted_sql, db_id) is not None:
+            return True, None
 
-    def check_sql(self,predicted_sql,db_path):
-        conn = sqlite3.connect(db_path)
-        conn.text_factory = bytes
-        cursor = conn.cursor()
         try:
-            cursor.execute(predicted_sql)
+            columns, rows = self._pool.execute(db_id, predicted_sql, max_rows=1)
         except Exception as e:
             return False, str(e)
-    
-        predicted_res = cursor.fetchall()
-        if len(predicted_res) > 0:
+
+        if len(rows) > 0:
             return True, None
         else:
             return False, "sql returns no value"
-        
-    def correct_sql(self, question, sql, message, db_path, attempt, **kwargs) -> str:
-        correction_prompt = self.get_correction_prompt(question, sql, message, **kwargs)
+
+    def analyze_sql(self, sql, db_id):
+        # Returns the normalized query and the error of the static analysis
+        analysis = self._sql_analyzer.analyze(sql, db_id)
+        if analysis.error is not None:
+            self.log(title="SQL Analysis", message=analysis.error)
+        return analysis.sql, analysis.error
+
+    def explain_sql(self, sql, db_id):
+        # Only compiles the query, returns the error or None
+        try:
+            self._pool.execute(db_id, 'EXPLAIN ' + sql)
+            return None
+        except Exception as e:
+            return str(e)
+
+    def correct_sql(self, question, sql, message, ddl_list=None, **kwargs) -> str:
+        db_id = kwargs.get('db_id')
+        correction_prompt = self.get_correction_prompt(question, sql, message, ddl_list=ddl_list, **kwargs)
         self.log(title="Correction Prompt", message=correction_prompt)
-        corrected_llm_response = self.submit_prompt(correction_prompt)
-        corrected_sql = self.extract_dict_value(corrected_llm_response, "corrected_SQL")
-        executable, new_message = self.check_sql(corrected_sql, db_path)
-        if executable or attempt == 2:
-            return self.extract_sql(corrected_sql), new_message
-        else:
-            self.log(title="SQL Correction needed: " + str(attempt + 1) + '. Attempt', message=new_message)
-            return self.correct_sql(question, corrected_sql, new_message, db_path, attempt + 1, **kwargs) 
+        responses = self.submit_prompt_candidates(correction_prompt, self.correction_candidates, json_mode=self.json_mode)
+
+        candidates = []
+        for response in responses:
+            corrected_sql = parse_correction(response).corrected_sql
+            if corrected_sql is not None:
+                corrected_sql = self.extract_sql(corrected_sql)
+                if corrected_sql not in candidates:
+                    candidates.append(corrected_sql)
+
+        if len(candidates) == 0:
+            return sql, message
+
+        # Candidates that don't pass the analysis or don't compile are dropped before any row is fetched
+        for corrected_sql in candidates:
+            corrected_sql, new_message = self.analyze_sql(corrected_sql, db_id)
+            if new_message is None:
+                new_message = self.explain_sql(corrected_sql, db_id)
+            if new_message is None:
+                executable, new_message = self.check_sql(corrected_sql, db_id)
+                if executable:
+                    return corrected_sql, None
+            self.log(title="Correction Candidate failed", message=new_message)
 
-    def get_correction_prompt(self, question, sql, message, **kwargs) -> str:
+        return corrected_sql, new_message
+
+    def get_correction_prompt(self, question, sql, message, ddl_list=None, **kwargs) -> str:
         initial_prompt = f"You are a {self.dialect} expert. There is a SQL query generated based on the following Database Schema to respond to the Question. Executing this SQL has resulted in an error and you need to fix it based on the error message, while following the system-interpetation of the question. \n"
         
-        ddl_list = self.get_related_ddl(question)
-        initial_prompt = self.add_ddl_to_prompt(
-            initial_prompt, ddl_list, max_tokens=self.max_tokens
-        )
+        closing_prompt = '\n' + f"Question:\n{question} \n"
+        closing_prompt += '\n' + f"System-Interpretation:\n{kwargs.get('plan')} \n"
+        closing_prompt += '\n' + f"Executed SQL:\n{sql} \n"
+        closing_prompt += '\n' + f"Error Message:\n{message} \n"
+
+        closing_prompt += '\n Please respond with a ' + self.get_dict_format() + ' storing the two keys "chain_of_thought_reasoning" and "corrected_SQL" written as a one-liner. \n'
 
-        initial_prompt += '\n' + f"Question:\n{question} \n"
-        initial_prompt += '\n' + f"System-Interpretation:\n{kwargs.get('plan')} \n"
-        initial_prompt += '\n' + f"Executed SQL:\n{sql} \n"
-        initial_prompt += '\n' + f"Error Message:\n{message} \n"
+        # The schema is packed into the budget that is left after the fixed text
+        builder = self.get_prompt_builder()
+        closing_tokens = builder.count(closing_prompt)
+        builder.reserve(closing_tokens)
+        builder.append(initial_prompt)
 
-        initial_prompt += '\n Please respond with a Python-Dictionary storing the two keys "chain_of_thought_reasoning" and "corrected_SQL" written as a one-liner. \n'
+        if ddl_list is None:
+            ddl_list = self.get_related_ddl(question)
+        self.add_ddl_to_builder(builder, ddl_list)
 
-        message_log = [self.system_message(initial_prompt)]
+        builder.release(closing_tokens)
+        builder.append(closing_prompt)
+
+        message_log = builder.get_messages()
         
         # Added for multi-turn-functionality
         #utterance_list = self._session.get_history()[-6:-1]
@@ -280,22 +588,10 @@ class VN_QsBase(Qdrant_VectorStore, OpenAI_Chat):
 
         return message_log
     
-    def extract_dict_value(self, llm_response: str, key: str):
-
-        pattern = r'\{.*?\}'
-
-        matches = re.findall(pattern, llm_response, re.DOTALL)
-        for match in matches:
-            try:
-                result = ast.literal_eval(match)
-                if isinstance(result, dict):
-                    return result[key]
-            except (ValueError, SyntaxError):
-                continue
-
-        print("No valid dictionary found.")
-        return None
-
+    ## Structured responses, parsed by response_parser
+    def get_dict_format(self) -> str:
+        # The JSON-mode of the provider requires the word JSON in the prompt
+        return "JSON-object" if self.json_mode else "Python-Dictionary"
 
     # Added to stay within the context-window
     def generate_summary(self, question: str, df: pd.DataFrame, **kwargs) -> str:
@@ -303,29 +599,41 @@ class VN_QsBase(Qdrant_VectorStore, OpenAI_Chat):
         summary = self.submit_prompt(summary_prompt, **kwargs)
         return summary
 
+    def generate_summary_stream(self, question: str, df: pd.DataFrame, **kwargs):
+        summary_prompt = self.get_summary_prompt(question, df, **kwargs)
+        return self.submit_prompt_stream(summary_prompt, **kwargs)
+
     def get_summary_prompt(self, question: str, df: pd.DataFrame, **kwargs) -> str:
         alternatives = kwargs.get('alternatives')
         self.log(title="Alternatives", message=str(alternatives))
 
+        system_prompt = f"You are a helpful data assistant. The user asked the question: '{question}'\n\nThe following is a pandas DataFrame with the results of the query: \n"
+        user_message = self.user_message(
+            "Briefly summarize the data based on the question that was asked. " \
+            f"Start a new paragraph before briefly summarizing the following alternatives without asking the user to choose. Instead, invite the user to let you know, if they'd like to see the result for any of them: {str(alternatives)} " \
+            "Do not respond with any additional explanation beyond the summary and invitation." +
+            self._response_language()
+        )
+
+        # The result may take up to half of the context-window
+        context_window = self.get_context_window(self.model)
+        budget = context_window / 2 if context_window is not None else self.max_tokens
+
+        builder = self.get_prompt_builder()
+        budget -= builder.count_messages([self.system_message(system_prompt + "\n\n"), user_message]) + 3
+        df_context = DataFrameContext(
+            df,
+            builder.count,
+            representation=self.summary_representation,
+            max_rows=self.summary_max_rows,
+            with_stats=self.summary_with_stats,
+        )
+
         message_log = [
-            self.system_message(
-                f"You are a helpful data assistant. The user asked the question: '{question}'\n\nThe following is a pandas DataFrame with the results of the query: \n{df[:100].to_markdown()}\n\n"
-            ),
-            self.user_message(
-                "Briefly summarize the data based on the question that was asked. " \
-                f"Start a new paragraph before briefly summarizing the following alternatives without asking the user to choose. Instead, invite the user to let you know, if they'd like to see the result for any of them: {str(alternatives)} " \
-                "Do not respond with any additional explanation beyond the summary and invitation." +
-                self._response_language()
-            ),
+            self.system_message(system_prompt + df_context.fit(budget) + "\n\n"),
+            user_message,
         ]
-        num_tokens = oc.num_tokens_from_messages(message_log, self.model)
-        context_window = self.get_context_window(self.model)
-        if num_tokens < (context_window / 2):
-            return message_log
-        else: 
-            row = len(df)
-            reduce = round(row * 0.75)
-            return self.get_summary_prompt(question, df[:reduce])
+        return message_log
 
     def get_context_window(self, model_name):
         context_windows = {
@@ -343,10 +651,38 @@ class VN_QsBase(Qdrant_VectorStore, OpenAI_Chat):
 
     # For multi-turn szenario
     def setUp_newSession(self):
-        self._session = VN_session()
+        self._session = self.new_session()
     
     def get_currentSession(self) -> VN_session:
         return self._session
+
+    def new_session(self) -> VN_session:
+        return VN_session(max_turns=self.session_max_turns, memory_window=self.history_window)
+
+    # For multi-user szenario
+    #   The copy shares the heavy parts (Qdrant-client, embedding-model, OpenAI-client,
+    #   connection-pool and caches) and only owns the session-history, the selected database
+    #   and its stored results, so other sessions can't evict a result that is still shown.
+    def new_user_context(self, db_id: str = None):
+        context = copy.copy(self)
+        context._session = self.new_session()
+        context._result_cache = OrderedDict()
+        context._result_lock = threading.Lock()
+        context.connect_to_sqlite_pool(db_id or self.db_id)
+        return context
+
+    # Replaces connect_to_sqlite. All queries go through the read-only connection pool.
+    def connect_to_sqlite_pool(self, db_id: str):
+        def run_sql_pool(sql: str, **kwargs) -> pd.DataFrame:
+            return self._pool.run_sql(db_id, sql)
+
+        self.db_id = db_id
+        self.dialect = "SQLite"
+        self.run_sql = run_sql_pool
+        self.run_sql_is_set = True
+
+    def run_sql_on(self, db_id: str, sql: str, params=()) -> pd.DataFrame:
+        return self._pool.run_sql(db_id, sql, params=params)
     
     def generate_sql(self, question: str, allow_llm_to_see_data=False, **kwargs) -> str:
         
@@ -355,16 +691,18 @@ class VN_QsBase(Qdrant_VectorStore, OpenAI_Chat):
         else:
             initial_prompt = None
         question_sql_list = self.get_similar_question_sql(question, **kwargs)
-        ddl_list = self.get_related_ddl(question, **kwargs)
+        ddl_list = kwargs.pop('ddl_list', None)
+        if ddl_list is None:
+            ddl_list = self.get_related_ddl(question, **kwargs)
         doc_list = self.get_related_documentation(question, **kwargs)
-        utterance_list = self._session.get_history()[-6:-1]
+        history_messages = self.get_history_messages()
         prompt = self.get_sql_prompt(
             initial_prompt=initial_prompt,
             question=question,
             question_sql_list=question_sql_list,
             ddl_list=ddl_list,
             doc_list=doc_list,
-            utterance_list = utterance_list,
+            history_messages = history_messages,
             **kwargs,
         )
         self.log(title="SQL Prompt", message=prompt)
@@ -375,125 +713,173 @@ class VN_QsBase(Qdrant_VectorStore, OpenAI_Chat):
     
 
     # Revision-Modul
-    def check_sql_for_release(self, predicted_sql, db_path):
-        conn = sqlite3.connect(db_path)
-        conn.text_factory = bytes
-        cursor = conn.cursor()
+    def check_sql_for_release(self, predicted_sql, db_id):
+        if self.get_cached_result(predicted_sql, db_id) is not None:
+            return True, predicted_sql, None
+
+        predicted_sql, error = self.analyze_sql(predicted_sql, db_id)
+        if error is not None:
+            return False, predicted_sql, error
+
+        df, error = self.execute_sql(predicted_sql, db_id)
+        if error is not None:
+            return False, predicted_sql, error
+
+        return True, predicted_sql, None
+
+    # Execution-Modul
+    #   Every query is executed once. The result is fetched in chunks into a ResultHandle:
+    #   a bounded preview in memory, the rest spilled to disk. The handle is kept, so that
+    #   the release-check and the display of the result don't run the query again.
+    def execute_sql(self, sql, db_id):
+        if sql is None:
+            return None, "no sql to execute"
+
         try:
-            cursor.execute(predicted_sql)
+            handle = self._result_store.fetch(self._pool, db_id, sql)
         except Exception as e:
-            return False, predicted_sql, str(e)
-    
-        return True, predicted_sql, None
-    
+            return None, str(e)
+
+        if handle.truncated:
+            self.log(title="Result truncated", message=f"Keeping the first {handle.num_rows} rows")
+        handle.preview.attrs['fingerprint'] = self.get_result_fingerprint(sql, db_id, handle.num_rows)
+
+        self._cache_result(sql, db_id, handle)
+        return handle.preview, None
+
+    def get_result_fingerprint(self, sql, db_id, num_rows) -> str:
+        # Identifies a result without hashing its rows; the database is read-only
+        fingerprint = hashlib.sha1(sql.strip().encode())
+        fingerprint.update(('\0' + db_id + '\0' + self._pool.get_schema_hash(db_id) + '\0' + str(num_rows)).encode())
+        return fingerprint.hexdigest()
+
+    def get_result(self, sql, db_id) -> pd.DataFrame:
+        # The preview of the result, its attrs tell the number of rows of the whole result
+        df = self.get_cached_result(sql, db_id)
+        if df is None:
+            df, error = self.execute_sql(sql, db_id)
+            if error is not None:
+                raise Exception(error)
+        return df
+
+    def get_result_handle(self, sql, db_id) -> ResultHandle:
+        if sql is None:
+            return None
+        key = (db_id, sql.strip())
+        with self._result_lock:
+            handle = self._result_cache.get(key)
+            if handle is not None:
+                self._result_cache.move_to_end(key)
+        return handle
+
+    def get_cached_result(self, sql, db_id):
+        handle = self.get_result_handle(sql, db_id)
+        return None if handle is None else handle.preview
+
+    def _cache_result(self, sql, db_id, handle):
+        key = (db_id, sql.strip())
+        evicted = []
+        with self._result_lock:
+            if key in self._result_cache and self._result_cache[key] is not handle:
+                evicted.append(self._result_cache[key])
+            self._result_cache[key] = handle
+            self._result_cache.move_to_end(key)
+            while len(self._result_cache) > self.result_cache_size:
+                evicted.append(self._result_cache.popitem(last=False)[1])
+        # The spilled files of evicted results are removed
+        for old_handle in evicted:
+            old_handle.close()
+
     # Interpretation-Modul
     def get_interpretation(self, question, **kwargs):
         ddl_list = self.get_all_ddl()
-        utterance_list = self._session.get_history()[-6:-1]
-        prompt = self.get_interpretation_prompt(question, ddl_list, utterance_list)
-        llm_response = self.submit_prompt(prompt, **kwargs)
-        plan = self.extract_dict_value(llm_response, "most_likely")
-        alternatives = self.extract_dict_value(llm_response, "alternatives")
-        print(alternatives)
-        return plan, alternatives
+        history_messages = self.get_history_messages()
+        prompt = self.get_interpretation_prompt(question, ddl_list, history_messages)
+        llm_response = self.submit_prompt(prompt, json_mode=self.json_mode, **kwargs)
+        interpretation = parse_interpretation(llm_response)
+        print(interpretation.alternatives)
+        return interpretation.most_likely, interpretation.alternatives
 
-    def get_interpretation_prompt(self, question, ddl_list, utterance_list):
-        initial_prompt = "You are a Database Expert System specialized in the {self.dialect} dialect. Your task is to interpret the user's natural language question, describe the most likely interpretation and generate a Python-list of other plausible interpretations or intentions behind it. These interpretations will serve as alternative plans for generating a SQL query in later steps. Use the provided database-schema and the conversation-context to guide your analysis. \n"
+    def get_interpretation_prompt(self, question, ddl_list, history_messages):
+        initial_prompt = f"You are a Database Expert System specialized in the {self.dialect} dialect. Your task is to interpret the user's natural language question, describe the most likely interpretation and generate a Python-list of other plausible interpretations or intentions behind it. These interpretations will serve as alternative plans for generating a SQL query in later steps. Use the provided database-schema and the conversation-context to guide your analysis. \n"
 
-        initial_prompt += '\n Please respond with a Python-Dictionary storing the three keys "chain_of_thought_reasoning", "most_likely" and "alternatives" written as a one-liner. '
+        initial_prompt += '\n Please respond with a ' + self.get_dict_format() + ' storing the three keys "chain_of_thought_reasoning", "most_likely" and "alternatives" written as a one-liner. '
         initial_prompt += '\n The value for "most_likely" should be the interpretation that is going to satisfy the user best and not include any extra information. '
         initial_prompt += '\n The value for "alternatives" must be a Python-list. The values for that list needs to be brief description of the other alternatives and not include any extra information. If there is only one clear primary interpretation, return [] \n'
 
-        initial_prompt = self.add_ddl_to_prompt(
-            initial_prompt, ddl_list, max_tokens=self.max_tokens
-        )
+        builder = self.get_prompt_builder()
+        closing_messages = [
+            self.system_message('Classify the following question:'),
+            self.user_message(question),
+        ]
+        closing_tokens = builder.count_messages(closing_messages)
+        builder.reserve(closing_tokens)
 
-        message_log = [self.system_message(initial_prompt)]
+        builder.append(initial_prompt)
+        self.add_ddl_to_builder(builder, ddl_list)
+        builder.flush_system()
         
         # Added for multi-turn-functionality
-        if len(utterance_list) > 0:
-            message_log.append(self.system_message('Past interactions in this session: '))
-            
-        for utterance in utterance_list:
-            if utterance is None:
-                print("no history")
-            else:
-                if utterance is not None and "question" in utterance and "query" in utterance:
-                    message_log.append(self.user_message(utterance["question"]))
-                    if utterance["query"] is not None:
-                        message_log.append(self.assistant_message(utterance["query"]))
-                    if utterance["summary"] is not None:
-                        message_log.append(self.assistant_message("Result-Summary: " + utterance["summary"]))
+        self.add_memory_to_builder(builder, max_tokens=self.memory_tokens)
+        self.add_history_to_builder(builder, history_messages, max_tokens=self.history_tokens)
         
-        message_log.append(self.system_message('Classify the following question:'))
-        message_log.append(self.user_message(question))
+        builder.release(closing_tokens)
+        builder.add_messages(closing_messages, force=True)
 
-        return message_log
+        return builder.get_messages()
 
 
 # Additional Functionalities
     # Suggest a Question
     def generate_questions(self, **kwargs) -> list[str]:
         ddl_list = self.get_all_ddl()
-        utterance_list = self._session.get_history()[-5:]
-        prompt = self.get_question_prompt(ddl_list, utterance_list, **kwargs)
-        llm_response = self.submit_prompt(prompt, **kwargs)
+        history_messages = self.get_history_messages(include_last=True)
+        prompt = self.get_question_prompt(ddl_list, history_messages, **kwargs)
+        llm_response = self.submit_prompt(prompt, json_mode=self.json_mode, **kwargs)
         return self.extract_questionList(llm_response)
     
+    # Served from the DDL-Cache, the DDL-collection is only scrolled on the first call
     def get_all_ddl(self):
-        trainingData = self.get_training_data()
-        ddlData = trainingData[trainingData.training_data_type=='ddl']
-        return ddlData['content'].tolist()
-    
-    def get_question_prompt(self,ddl_list, utterance_list, **kwargs):
-        initial_prompt = f"Generate 5 questions about the following database, that can be answered with a SQL query. This means that the question should have specific values and can be given to a NLIDB without any changes. Consider what users asked in the past and suggest questions that help them explore the database. "
-        initial_prompt += "Return just the question without any additional explanation. The ouput needs to be in one python-list written as a one-liner."
-        initial_prompt = self.add_ddl_to_prompt(
-            initial_prompt, ddl_list, max_tokens=self.max_tokens
-        )
+        return self._ddl_cache.get_all()
 
-        message_log = [self.system_message(initial_prompt)]
+    def _load_all_ddl(self) -> dict:
+        ddl_points = self._get_all_points(self.ddl_collection_name)
+        return {self._format_point_id(point.id, self.ddl_collection_name): point.payload["ddl"] for point in ddl_points}
 
-        if len(utterance_list) > 0:
-            message_log.append(self.system_message('Past interactions in this session: '))
-        
-        for utterance in utterance_list:
-            if utterance is None:
-                print("no history")
-            else:
-                if utterance is not None and "question" in utterance and "query" in utterance:
-                    message_log.append(self.user_message(utterance["question"]))
-                    if utterance["query"] is not None:
-                        message_log.append(self.assistant_message(utterance["query"]))
-                    if utterance["summary"] is not None:
-                        message_log.append(self.assistant_message("Result-Summary: " + utterance["summary"]))
+    def get_ddl_epoch(self) -> int:
+        return self._ddl_cache.get_epoch()
 
-        return message_log
+    def invalidate_ddl_cache(self):
+        self._ddl_cache.invalidate()
     
-    def extract_questionList(self, llm_response: str) -> list[str]:
-
-        start = "["
-        end = "]"
-
-        # Find the index of the start substring
-        idx1 = llm_response.find(start)
+    def get_question_prompt(self,ddl_list, history_messages, **kwargs):
+        initial_prompt = f"Generate 5 questions about the following database, that can be answered with a SQL query. This means that the question should have specific values and can be given to a NLIDB without any changes. Consider what users asked in the past and suggest questions that help them explore the database. "
+        if self.json_mode:
+            initial_prompt += 'Return just the question without any additional explanation. The ouput needs to be a JSON-object storing the questions as a list under the key "questions", written as a one-liner.'
+        else:
+            initial_prompt += "Return just the question without any additional explanation. The ouput needs to be in one python-list written as a one-liner."
 
-        # Find the index of the end substring, starting after the start substring
-        idx2 = llm_response.find(end, idx1 + len(start))
+        builder = self.get_prompt_builder()
+        builder.append(initial_prompt)
+        self.add_ddl_to_builder(builder, ddl_list)
+        builder.flush_system()
 
-        # Check if both delimiters are found and extract the substring between them
-        if idx1 != -1 and idx2 != -1:
-            res = llm_response[idx1 + len(start):idx2]
-            return eval('[' + res + ']')
+        self.add_history_to_builder(builder, history_messages)
 
-        else:
-            print("Delimiters not found")
+        return builder.get_messages()
+    
+    def extract_questionList(self, llm_response: str) -> list[str]:
+        return parse_question_list(llm_response)
 
     # Generate Plot
+    def get_value_columns(self, df: pd.DataFrame) -> list:
+        # Numeric columns that aren't ids are the values of a chart
+        num_columns = list(df.select_dtypes(include=['number']))
+        return [col for col in num_columns if not str(col).lower().endswith("id")]
+
     def should_generate_chart(self, df: pd.DataFrame) -> bool:
         if super().should_generate_chart(df):
-            num_columns = list(df.select_dtypes(include=['number']))
-            return any(not col.lower().endswith("id") for col in num_columns)
+            return len(self.get_value_columns(df)) > 0
         else:
             return False
         
@@ -516,7 +902,24 @@ class VN_QsBase(Qdrant_VectorStore, OpenAI_Chat):
 
         return self._sanitize_plotly_code(self._extract_python_code(plotly_code))
     
+    def get_plotly_figure(self, plotly_code: str, df: pd.DataFrame, dark_mode: bool = True):
+        # Generated code runs in the worker processes, not in the server
+        if self._plot_workers is None:
+            return super().get_plotly_figure(plotly_code=plotly_code, df=df, dark_mode=dark_mode)
+        return self._plot_workers.get_plotly_figure(plotly_code, df, dark_mode=dark_mode)
+
     def generate_sql_explanation_on_demand(self, sql, related_question, **kwargs):
+        message_log = self.get_sql_explanation_prompt(sql, related_question)
+
+        explanation = self.submit_prompt(message_log, **kwargs)
+
+        return explanation
+
+    def generate_sql_explanation_on_demand_stream(self, sql, related_question, **kwargs):
+        message_log = self.get_sql_explanation_prompt(sql, related_question)
+        return self.submit_prompt_stream(message_log, **kwargs)
+
+    def get_sql_explanation_prompt(self, sql, related_question):
         message_log = [
             self.system_message(
                 f"You are a helpful data assistant. The user has asked the question: '{related_question}'\n\nThe following is the generated query: \n{sql}\n\n"
@@ -526,12 +929,20 @@ class VN_QsBase(Qdrant_VectorStore, OpenAI_Chat):
                 self._response_language()
             ),
         ]
+        return message_log
+    
+    def generate_error_response(self, question, message, **kwargs):
+        message_log = self.get_error_response_prompt(question, message)
 
         explanation = self.submit_prompt(message_log, **kwargs)
 
         return explanation
-    
-    def generate_error_response(self, question, message, **kwargs):
+
+    def generate_error_response_stream(self, question, message, **kwargs):
+        message_log = self.get_error_response_prompt(question, message)
+        return self.submit_prompt_stream(message_log, **kwargs)
+
+    def get_error_response_prompt(self, question, message):
         message_log = [
             self.system_message(
                 f"You are a helpful data assistant. In order to generate a sql-query the user has asked the question: '{question}'\n\nThe following is the message of the system or database: \n{message}\n\n"
@@ -544,12 +955,20 @@ class VN_QsBase(Qdrant_VectorStore, OpenAI_Chat):
                 self._response_language()
             ),
         ]
-
-        explanation = self.submit_prompt(message_log, **kwargs)
-
-        return explanation
+        return message_log
     
     def genenerate_interpretation_respond(self, question, plan, **kwargs):
+        message_log = self.get_interpretation_respond_prompt(question, plan)
+
+        interpretation_respond = self.submit_prompt(message_log, **kwargs)
+
+        return interpretation_respond
+
+    def genenerate_interpretation_respond_stream(self, question, plan, **kwargs):
+        message_log = self.get_interpretation_respond_prompt(question, plan)
+        return self.submit_prompt_stream(message_log, **kwargs)
+
+    def get_interpretation_respond_prompt(self, question, plan):
         message_log = [
             self.system_message(
                 f"You are a helpful data assistant. The user has asked the following question:\n'{question}'\n\nThe system has interpreted the question as: \n{plan}\n\n"
@@ -560,7 +979,74 @@ class VN_QsBase(Qdrant_VectorStore, OpenAI_Chat):
                 self._response_language()
             ),
         ]
+        return message_log
 
-        interpretation_respond = self.submit_prompt(message_log, **kwargs)
-
-        return interpretation_respond
\ No newline at end of file
+    # Prompt-Caching
+    #   The prompts start with a stable prefix (instructions, sorted DDL, documentation) and
+    #   end with the variable part (examples, history, question), so that the provider can
+    #   reuse the prefix. The cached tokens reported in the usage are recorded per prefix.
+    def get_prompt_prefix_hash(self, prompt) -> str:
+        return hashlib.sha1(prompt[0]["content"].encode()).hexdigest()[:16]
+
+    def record_prompt_usage(self, prefix_hash: str, usage):
+        if usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", None) or 0
+        with self._prompt_stats_lock:
+            stats = self._prompt_stats.setdefault(prefix_hash, {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0})
+            stats["calls"] += 1
+            stats["prompt_tokens"] += usage.prompt_tokens
+            stats["cached_tokens"] += cached_tokens
+        self.log(title="Prompt Usage", message=f"prefix {prefix_hash}: {usage.prompt_tokens} prompt tokens, {cached_tokens} cached")
+
+    def get_prompt_stats(self) -> dict:
+        with self._prompt_stats_lock:
+            return {prefix_hash: dict(stats) for prefix_hash, stats in self._prompt_stats.items()}
+
+    # Override of OpenAI_Chat, to read the usage of the response
+    def submit_prompt(self, prompt, **kwargs) -> str:
+        return self.submit_prompt_candidates(prompt, 1, **kwargs)[0]
+
+    def submit_prompt_candidates(self, prompt, n: int, **kwargs) -> list:
+        # n completions of the same prompt in one request, the prompt is only paid once
+        if prompt is None or len(prompt) == 0:
+            raise Exception("Prompt is empty")
+
+        model = kwargs.get("model", None) or self.config.get("model")
+        options = {}
+        if kwargs.get("json_mode"):
+            options["response_format"] = {"type": "json_object"}
+        if n > 1:
+            options["n"] = n
+        response = self.client.chat.completions.create(
+            model=model,
+            messages=prompt,
+            stop=None,
+            temperature=self.temperature,
+            **options,
+        )
+        self.record_prompt_usage(self.get_prompt_prefix_hash(prompt), response.usage)
+        return [choice.message.content for choice in response.choices]
+
+    # Streaming
+    #   Yields the completion chunk by chunk, so that the first tokens can be shown
+    #   (e.g. with st.write_stream) before the full response has arrived.
+    def submit_prompt_stream(self, prompt, **kwargs):
+        if prompt is None or len(prompt) == 0:
+            raise Exception("Prompt is empty")
+
+        model = kwargs.get("model", None) or self.config.get("model")
+        response = self.client.chat.completions.create(
+            model=model,
+            messages=prompt,
+            stop=None,
+            temperature=self.temperature,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        for chunk in response:
+            if len(chunk.choices) > 0 and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+            if getattr(chunk, "usage", None) is not None:
+                self.record_prompt_usage(self.get_prompt_prefix_hash(prompt), chunk.usage)
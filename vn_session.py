@@ -1,38 +1,169 @@
+import hashlib
+import threading
+from collections import deque
+
 import pandas as pd
 
+# A turn of the conversation. Like the former dicts it can be read with turn["key"] and turn.get("key")
+class Turn():
+    __slots__ = ('question', 'query', 'summary', 'interpretation', 'dataframe')
+
+    def __init__(self, question: str = None, query: str = None, summary: str = None, interpretation: str = None, dataframe=None):
+        self.question = question
+        self.query = query
+        self.summary = summary
+        self.interpretation = interpretation
+        self.dataframe = dataframe
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key) -> bool:
+        return key in self.__slots__
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.__slots__ else default
+
+    def to_dict(self) -> dict:
+        return {key: getattr(self, key) for key in self.__slots__}
+
+    def compress(self, max_chars: int = 200) -> str:
+        # One line per turn for the session memory: question, SQL and the first sentence of the summary
+        def shorten(text: str) -> str:
+            text = ' '.join(str(text).split())
+            return text if len(text) <= max_chars else text[:max_chars - 3] + '...'
+
+        line = 'Q: ' + shorten(self.question)
+        if self.query is not None:
+            line += ' | SQL: ' + shorten(self.query)
+        if isinstance(self.dataframe, DataFrameRef):
+            line += ' | Result: ' + str(self.dataframe.shape[0]) + ' rows'
+        if self.summary is not None:
+            line += ' | Summary: ' + shorten(self.summary.split('. ')[0])
+        return line + '\n'
+
+# Instead of the DataFrame, a turn only keeps its shape, a hash and the first rows
+class DataFrameRef():
+    __slots__ = ('shape', 'columns', 'hash', 'head')
+
+    def __init__(self, df: pd.DataFrame, head_rows: int = 3):
+        self.shape = df.shape
+        self.columns = [str(col) for col in df.columns]
+        self.hash = hashlib.sha1(pd.util.hash_pandas_object(df, index=True).values.tobytes()).hexdigest()
+        self.head = df.head(head_rows).to_dict('records')
+
+    def __repr__(self) -> str:
+        return f"DataFrameRef(shape={self.shape}, hash={self.hash[:12]})"
+
+# Session-Memory
+#   The prompts show the last memory_window turns verbatim. A turn that falls out of that
+#   window is folded into the memory as a single line. Beyond max_memory_lines only the
+#   question of the oldest lines is kept, so the memory covers the whole conversation.
 class VN_session():
-    def __init__(self,history=None):
-        if history is None:
-            self._history = []
-        else:
-            self._history = history
+    def __init__(self, history=None, max_turns: int = 20, memory_window: int = 5, max_memory_lines: int = 20):
+        # Ring buffer, the oldest turn is dropped when a new one is added to a full history
+        self._history = deque(maxlen=max(max_turns, memory_window + 2))
+        self.memory_window = memory_window
+        self._memory = deque()
+        self.max_memory_lines = max_memory_lines
+        self._topics = deque(maxlen=max_memory_lines)
+        self._lock = threading.Lock()
+        self._version = 0
+        self._num_turns = 0
+        self._rendered = {}
+        if history is not None:
+            self.set_history(history)
+
+    def _to_turn(self, turn) -> Turn:
+        if isinstance(turn, Turn):
+            return turn
+        turn = Turn(**{key: value for key, value in turn.items() if key in Turn.__slots__})
+        if isinstance(turn.dataframe, pd.DataFrame):
+            turn.dataframe = DataFrameRef(turn.dataframe)
+        return turn
+
+    def _changed(self):
+        self._version += 1
+        self._rendered.clear()
 
-    
     def get_history(self) -> list:
-        return self._history
+        return list(self._history)
+
+    def get_window(self, size: int, include_last: bool = False) -> list:
+        # The last size turns, without the current turn unless include_last is set
+        turns = list(self._history)
+        if not include_last:
+            turns = turns[:-1]
+        return turns[-size:] if size > 0 else []
+
+    def get_version(self) -> int:
+        return self._version
+
+    def get_num_turns(self) -> int:
+        return self._num_turns
+
+    def get_memory(self) -> list:
+        memory = [line for question, line in self._memory]
+        if len(self._topics) > 0:
+            memory.insert(0, 'Earlier questions: ' + '; '.join(self._topics) + '\n')
+        return memory
+
+    def _fold(self):
+        # Called after a turn was added: the turn that just left the verbatim window goes into the memory
+        position = self.memory_window + 2
+        if len(self._history) < position:
+            return
+        turn = self._history[-position]
+        self._memory.append((' '.join(str(turn.question).split()), turn.compress()))
+        if len(self._memory) > self.max_memory_lines:
+            question, line = self._memory.popleft()
+            self._topics.append(question)
+
+    def get_rendered(self, key, render):
+        # Rendered views of the history (e.g. prompt-messages) are kept until the next change
+        with self._lock:
+            if key in self._rendered:
+                return self._rendered[key]
+            version = self._version
+        value = render()
+        with self._lock:
+            if version == self._version:
+                self._rendered[key] = value
+        return value
 
     def set_history(self,history: list):
-        self._history = history
+        with self._lock:
+            self._history.clear()
+            self._memory.clear()
+            self._topics.clear()
+            for turn in history:
+                self._history.append(self._to_turn(turn))
+                self._fold()
+            self._num_turns = len(history)
+            self._changed()
 
     def add_turnToHistory(self, questionSQLpair: dict):
-        self._history.append(questionSQLpair)
+        with self._lock:
+            self._history.append(self._to_turn(questionSQLpair))
+            self._fold()
+            self._num_turns += 1
+            self._changed()
+
+    def _set_on_last_turn(self, key: str, value):
+        with self._lock:
+            setattr(self._history[-1], key, value)
+            self._changed()
 
     def add_sqlToLastTurn(self, sql:str):
-        lastDict = self._history[-1]
-        lastDict['query'] = sql
-        self._history[-1] = lastDict
+        self._set_on_last_turn('query', sql)
 
     def add_summaryToLastTurn(self, summary:str):
-        lastDict = self._history[-1]
-        lastDict['summary'] = summary
-        self._history[-1] = lastDict
+        self._set_on_last_turn('summary', summary)
 
     def add_dataframeToLastTurn(self, df: pd.DataFrame):
-        lastDict = self._history[-1]
-        lastDict['dataframe'] = df
-        self._history[-1] = lastDict
+        self._set_on_last_turn('dataframe', DataFrameRef(df))
 
     def add_interpretationToLastTurn(self, interpretation:str):
-        lastDict = self._history[-1]
-        lastDict['interpretation'] = interpretation
-        self._history[-1] = lastDict
+        self._set_on_last_turn('interpretation', interpretation)